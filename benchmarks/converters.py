@@ -0,0 +1,392 @@
+"""Benchmarks of the converters over tests/testfiles and generated inputs.
+
+Each case runs in a fresh child-process, with the converters imported before
+it is timed. The peak RSS of the process is reported, and how much the case
+added to it (+MB). Generated inputs are kept in the workdir between runs.
+
+Run from the root of the repository:
+    poetry run python benchmarks/converters.py
+    poetry run python benchmarks/converters.py --quick --json bench.json
+"""
+import json
+import subprocess
+import sys
+import shutil
+from argparse import ArgumentParser
+from os import environ as env
+from time import perf_counter
+from typing import Any, Callable, List, Dict, Optional, Tuple
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+TESTFILES = ROOT / "tests" / "testfiles"
+FFMPEG = Path.home() / ".aca" / "workflows" / "bin" / "ffmpeg.exe"
+
+
+def _setup_env(workdir: Path) -> None:
+    """Fills in the config the converters read from the environment, unless
+    it is already set, e.g. by loading config.json"""
+
+    env.setdefault("APP_DIR", ".aca/workflows")
+    env.setdefault("SAM_IMAGE_FORMATS", ".jpg .JPG .jpeg .png .tif .tiff")
+    env.setdefault("SAM_VIDEO_FORMATS", ".mp4 .mov")
+    env.setdefault("SAM_AUDIO_FORMATS", ".wav .mp3")
+    env.setdefault("SAM_ACCESS_LARGE_SIZE", "1920")
+    env.setdefault("SAM_ACCESS_MEDIUM_SIZE", "640")
+    env.setdefault("SAM_ACCESS_SMALL_SIZE", "150")
+    env.setdefault("SAM_WATERMARK_WIDTH", "200")
+    env.setdefault("SAM_WATERMARK_HEIGHT", "50")
+
+    if "SAM_WATERMARK_WHITE" not in env:
+        from PIL import Image
+
+        # Absolute paths, as the watermark is looked up relative to APP_DIR
+        size = (int(env["SAM_WATERMARK_WIDTH"]), int(env["SAM_WATERMARK_HEIGHT"]))
+        for color in ["white", "black"]:
+            logo: Path = workdir / f"watermark_{color}.png"
+            if not logo.exists():
+                Image.new("RGBA", size, color).save(logo)
+            env[f"SAM_WATERMARK_{color.upper()}"] = str(logo)
+
+
+def _thumbnails() -> List[Dict]:
+    return [
+        {"size": int(env["SAM_ACCESS_SMALL_SIZE"]), "suffix": "_s"},
+        {"size": int(env["SAM_ACCESS_MEDIUM_SIZE"]), "suffix": "_m"},
+        {"size": int(env["SAM_ACCESS_LARGE_SIZE"]), "suffix": "_l"},
+    ]
+
+
+##########
+# Inputs #
+##########
+def _make_tiff16(path: Path, quick: bool) -> None:
+    import numpy as np
+    from PIL import Image
+
+    width, height = (1000, 800) if quick else (8000, 6000)
+    ramp = np.linspace(0, 2**16 - 1, width, dtype=np.uint16)
+    Image.fromarray(np.tile(ramp, (height, 1))).save(path)
+
+
+def _make_jpeg(path: Path, quick: bool) -> None:
+    import numpy as np
+    from PIL import Image
+
+    # 16384 x 12288 is about 200 megapixels
+    width, height = (4000, 3000) if quick else (16384, 12288)
+    rng = np.random.default_rng(0)
+    block = rng.integers(0, 256, (256, 256, 3), dtype=np.uint8)
+    data = np.tile(block, (height // 256, width // 256, 1))
+    Image.fromarray(data).save(path, quality=90)
+
+
+def _make_pdf(path: Path, quick: bool) -> None:
+    import fitz
+
+    doc = fitz.open()
+    for i in range(20 if quick else 400):
+        page = doc.new_page()
+        page.insert_text((72, 72), f"Side {i + 1}", fontsize=24)
+        page.draw_rect(fitz.Rect(72, 120, 520, 700), color=(0, 0, 1), width=2)
+    doc.save(path)
+    doc.close()
+
+
+def _make_video(path: Path, quick: bool) -> None:
+    seconds: int = 30 if quick else 1800
+    subprocess.run(
+        [
+            FFMPEG,
+            "-loglevel",
+            "error",
+            "-f",
+            "lavfi",
+            "-i",
+            f"testsrc2=size=1920x1080:rate=25:duration={seconds}",
+            "-f",
+            "lavfi",
+            "-i",
+            f"sine=frequency=440:duration={seconds}",
+            "-c:v",
+            "mpeg2video",
+            "-q:v",
+            "4",
+            "-c:a",
+            "pcm_s16le",
+            path,
+        ],
+        check=True,
+    )
+
+
+def _make_audio(path: Path, quick: bool) -> None:
+    seconds: int = 60 if quick else 3600
+    subprocess.run(
+        [
+            FFMPEG,
+            "-loglevel",
+            "error",
+            "-f",
+            "lavfi",
+            "-i",
+            f"sine=frequency=440:duration={seconds}",
+            "-ac",
+            "2",
+            path,
+        ],
+        check=True,
+    )
+
+
+GENERATED: Dict[str, Tuple[str, Callable[[Path, bool], None], bool]] = {
+    # name: (filename, generator, needs ffmpeg)
+    "tiff16": ("tiff16.tif", _make_tiff16, False),
+    "jpeg200mp": ("jpeg200mp.jpg", _make_jpeg, False),
+    "pdf400": ("pdf400.pdf", _make_pdf, False),
+    "video": ("video.mov", _make_video, True),
+    "audio": ("audio.wav", _make_audio, True),
+}
+
+
+def _generate(workdir: Path, quick: bool) -> None:
+    for name, (filename, generator, needs_ffmpeg) in GENERATED.items():
+        path: Path = workdir / filename
+        if path.exists() or (needs_ffmpeg and not FFMPEG.is_file()):
+            continue
+        print(f"Generating {path}...", flush=True)
+        generator(path, quick)
+
+
+#########
+# Cases #
+#########
+def _image(in_file: Path, out_dir: Path) -> None:
+    import workflows.converters as converters
+
+    converters.image_thumbnails(
+        in_file, out_dir, thumbnails=_thumbnails(), overwrite=True
+    )
+
+
+def _pdf(in_file: Path, out_dir: Path) -> None:
+    import workflows.converters as converters
+
+    converters.pdf_thumbnails(
+        in_file, out_dir, thumbnails=_thumbnails(), no_watermark=False, overwrite=True
+    )
+
+
+def _pdf_optimize(in_file: Path, out_dir: Path) -> None:
+    import workflows.converters as converters
+
+    converters.pdf_optimize(in_file, out_dir / "optimized.pdf", dpi=150, overwrite=True)
+
+
+def _watermark(in_file: Path, out_dir: Path) -> None:
+    from PIL import Image
+    from workflows.utils import watermark
+
+    img: Any = Image.open(in_file).convert("RGB")
+    img.thumbnail((int(env["SAM_ACCESS_LARGE_SIZE"]),) * 2)
+    for _ in range(20):
+        watermark.add_watermark_to_image(img)
+
+
+def _video_convert(in_file: Path, out_dir: Path) -> None:
+    import workflows.converters as converters
+
+    converters.video_convert(
+        in_file, out_dir / "video.mp4", timeout=24 * 3600, overwrite=True
+    )
+
+
+def _video_thumbnails(in_file: Path, out_dir: Path) -> None:
+    import workflows.converters as converters
+
+    converters.video_thumbnails(
+        in_file, out_dir, thumbnails=_thumbnails(), overwrite=True
+    )
+
+
+def _video_convert_thumbnails(in_file: Path, out_dir: Path) -> None:
+    import workflows.converters as converters
+
+    converters.video_convert_thumbnails(
+        in_file,
+        out_dir / "video.mp4",
+        out_dir,
+        thumbnails=_thumbnails(),
+        timeout=24 * 3600,
+        overwrite=True,
+    )
+
+
+def _audio_convert(in_file: Path, out_dir: Path) -> None:
+    import workflows.converters as converters
+
+    converters.audio_convert(
+        in_file, out_dir / "audio.mp3", timeout=24 * 3600, overwrite=True
+    )
+
+
+def _cases(workdir: Path) -> Dict[str, Tuple[Callable[[Path, Path], None], Path]]:
+    """Returns the runner and input-file of each case, for the inputs that
+    exist"""
+
+    cases: Dict[str, Tuple[Callable[[Path, Path], None], Path]] = {}
+    for f in sorted(TESTFILES.iterdir()):
+        if f.suffix == ".pdf":
+            cases[f"pdf_thumbnails[{f.name}]"] = (_pdf, f)
+        else:
+            cases[f"image_thumbnails[{f.name}]"] = (_image, f)
+    cases["watermark_x20[5.png]"] = (_watermark, TESTFILES / "5.png")
+
+    generated: Dict[str, Path] = {
+        name: workdir / filename for name, (filename, _, _) in GENERATED.items()
+    }
+    cases["image_thumbnails[tiff16]"] = (_image, generated["tiff16"])
+    cases["image_thumbnails[jpeg200mp]"] = (_image, generated["jpeg200mp"])
+    cases["watermark_x20[jpeg200mp]"] = (_watermark, generated["jpeg200mp"])
+    cases["pdf_thumbnails[pdf400]"] = (_pdf, generated["pdf400"])
+    cases["pdf_optimize[pdf400]"] = (_pdf_optimize, generated["pdf400"])
+    cases["video_convert[video]"] = (_video_convert, generated["video"])
+    cases["video_thumbnails[video]"] = (_video_thumbnails, generated["video"])
+    cases["video_convert_thumbnails[video]"] = (
+        _video_convert_thumbnails,
+        generated["video"],
+    )
+    cases["audio_convert[audio]"] = (_audio_convert, generated["audio"])
+
+    return {k: v for k, v in cases.items() if v[1].exists()}
+
+
+def _peak_rss() -> int:
+    """Returns the peak resident set size of this process in bytes"""
+
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [
+                ("cb", wintypes.DWORD),
+                ("PageFaultCount", wintypes.DWORD),
+                ("PeakWorkingSetSize", ctypes.c_size_t),
+                ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t),
+                ("PeakPagefileUsage", ctypes.c_size_t),
+            ]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.psapi.GetProcessMemoryInfo(  # type: ignore[attr-defined]
+            ctypes.windll.kernel32.GetCurrentProcess(),  # type: ignore[attr-defined]
+            ctypes.byref(counters),
+            counters.cb,
+        )
+        return int(counters.PeakWorkingSetSize)
+
+    import resource
+
+    peak: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kB, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _run_case(name: str, workdir: Path) -> Dict[str, Any]:
+    """Runs a single case in this process"""
+
+    _setup_env(workdir)
+    runner, in_file = _cases(workdir)[name]
+    out_dir: Path = workdir / "out" / name.replace("[", "_").replace("]", "")
+    shutil.rmtree(out_dir, ignore_errors=True)
+    out_dir.mkdir(parents=True)
+
+    # Import up front, so neither the time nor the memory of the case
+    # includes loading fitz, numpy and PIL
+    import PIL.Image  # noqa: F401
+    import workflows.converters  # noqa: F401
+    import workflows.utils.watermark  # noqa: F401
+
+    baseline: int = _peak_rss()
+    error: Optional[str] = None
+    start: float = perf_counter()
+    try:
+        runner(in_file, out_dir)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    seconds: float = perf_counter() - start
+
+    return {
+        "case": name,
+        "bytes_in": in_file.stat().st_size,
+        "seconds": seconds,
+        "peak_rss": _peak_rss(),
+        "baseline_rss": baseline,
+        "error": error,
+    }
+
+
+def main() -> None:
+    cli = ArgumentParser(description="Benchmark the converters")
+    cli.add_argument("--workdir", type=Path, default=ROOT / ".benchmarks")
+    cli.add_argument("--quick", action="store_true", help="Use small generated inputs")
+    cli.add_argument("--filter", default="", help="Only run cases containing this")
+    cli.add_argument("--json", type=Path, help="Save the results as json")
+    cli.add_argument("--case", help="Internal: run a single case and print json")
+    args = cli.parse_args()
+
+    # Keep quick and full inputs apart, as they share filenames
+    workdir: Path = args.workdir / ("quick" if args.quick else "full")
+    workdir.mkdir(parents=True, exist_ok=True)
+
+    if args.case:
+        print(json.dumps(_run_case(args.case, workdir)))
+        return
+
+    _setup_env(workdir)
+    _generate(workdir, args.quick)
+    if not FFMPEG.is_file():
+        print(f"No ffmpeg at {FFMPEG}. Skipping audio- and video-cases", flush=True)
+
+    results: List[Dict[str, Any]] = []
+    print(
+        f"{'case':<40}{'MB in':>10}{'seconds':>10}{'peak MB':>10}{'+MB':>10}",
+        flush=True,
+    )
+    for name in _cases(workdir):
+        if args.filter not in name:
+            continue
+        cmd = [sys.executable, __file__, "--workdir", str(args.workdir), "--case", name]
+        if args.quick:
+            cmd.append("--quick")
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        result: Dict[str, Any]
+        if proc.returncode != 0:
+            result = {"case": name, "error": proc.stderr.strip().splitlines()[-1]}
+        else:
+            result = json.loads(proc.stdout.strip().splitlines()[-1])
+        results.append(result)
+
+        if result.get("error"):
+            print(f"{name:<40} failed: {result['error']}", flush=True)
+        else:
+            print(
+                f"{name:<40}{result['bytes_in'] / 1e6:>10.1f}"
+                f"{result['seconds']:>10.2f}{result['peak_rss'] / 1e6:>10.0f}"
+                f"{(result['peak_rss'] - result['baseline_rss']) / 1e6:>10.0f}",
+                flush=True,
+            )
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as ofile:
+            json.dump(results, ofile, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 import sys
 import locale
+import multiprocessing
 from argparse import ArgumentParser
 from pathlib import Path
 
@@ -100,6 +101,64 @@ def main() -> None:
         action="store_true",
         help="Filerne lægges lokalt i 'Overførsler'-mappen og online i en 'test'-mappe",
     )
+    sam_access.add_argument(
+        "--workers",
+        metavar="Antal processer",
+        type=int,
+        default=1,
+        widget="IntegerField",
+        help="Antal filer, der konverteres samtidigt",
+    )
+    sam_access.add_argument(
+        "--resume",
+        metavar="Genoptag",
+        action="store_true",
+        help="Genoptag en afbrudt kørsel med samme output-fil og spring færdige filer over",
+    )
+    sam_access.add_argument(
+        "--cache-size",
+        metavar="Cache (GB)",
+        type=int,
+        default=10,
+        widget="IntegerField",
+        help="Genbrug accessfiler fra tidligere kørsler op til denne størrelse. 0 slår cachen fra",
+    )
+    sam_access.add_argument(
+        "--prefetch-size",
+        metavar="Prefetch (GB)",
+        type=int,
+        default=2,
+        widget="IntegerField",
+        help="Kopiér de næste masterfiler lokalt op til denne størrelse, mens der konverteres. 0 slår det fra",
+    )
+    sam_access.add_argument(
+        "--plan-only",
+        metavar="Kun planlægning",
+        action="store_true",
+        help="Gennemgå csv-filen og estimér kørselstiden uden at konvertere noget",
+    )
+    sam_access.add_argument(
+        "--pdf-optimize",
+        metavar="Optimér pdf-filer",
+        action="store_true",
+        help="Komprimér og linearisér accesskopier af pdf-filer til hurtig visning på nettet",
+    )
+    sam_access.add_argument(
+        "--pdf-dpi",
+        metavar="Opløsning i pdf-filer (dpi)",
+        type=int,
+        default=0,
+        widget="IntegerField",
+        help="Nedskalér billeder i optimerede pdf-filer til denne opløsning. 0 bevarer opløsningen",
+    )
+    sam_access.add_argument(
+        "--upload-concurrency",
+        metavar="Samtidige uploads",
+        type=int,
+        default=8,
+        widget="IntegerField",
+        help="Antal filer, der uploades samtidigt",
+    )
 
     ###############
     # Search-parser
@@ -157,6 +216,14 @@ def main() -> None:
                 local=args.local,
                 overwrite=args.overwrite,
                 dryrun=args.dryrun,
+                workers=args.workers,
+                resume=args.resume,
+                cache_size=args.cache_size,
+                prefetch_size=args.prefetch_size,
+                plan_only=args.plan_only,
+                pdf_optimize=args.pdf_optimize,
+                pdf_dpi=args.pdf_dpi,
+                upload_concurrency=args.upload_concurrency,
             )
         except Exception as e:
             sys.exit(str(e))
@@ -181,4 +248,6 @@ def main() -> None:
 
 
 if __name__ == "__main__":
+    # necessary for worker-processes in pyinstaller-executables
+    multiprocessing.freeze_support()
     sys.exit(main())
@@ -1,6 +1,6 @@
 # from logging import error
 import os
-from typing import List, Dict
+from typing import Any, List, Dict, Optional
 from pathlib import Path
 
 from azure.storage.blob import ContainerClient
@@ -18,34 +18,77 @@ class UploadError(ACAError):
     """
 
 
+class Uploader:
+    """Uploads files to a container for a whole job, instead of connecting
+    once per row.
+
+    The ContainerClient, and with it the pool of HTTP-connections of its
+    transport, is created on the first upload and reused for the following
+    ones. The existence of the container is only checked once. Use as a
+    context-manager, or call close() when done.
+    """
+
+    def __init__(self, container: str, connection_string: Optional[str] = None):
+        self.container: str = container
+        self._connection_string: Optional[str] = connection_string or os.getenv(
+            "AZURE_STORAGE_CONNECTION_STRING"
+        )
+        self._client: Optional[ContainerClient] = None
+        self._exists: Optional[bool] = None
+
+    def __enter__(self) -> "Uploader":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def _container_client(self) -> ContainerClient:
+        if self._client is None:
+            self._client = ContainerClient.from_connection_string(
+                self._connection_string, self.container
+            )
+        if self._exists is None:
+            self._exists = self._client.exists()
+        if not self._exists:
+            raise ACAError(f"No such container exists: {self.container}")
+        return self._client
+
+    def upload_files(
+        self, filelist: List[Dict], subpath: str, overwrite: bool = False
+    ) -> None:
+        container_client: ContainerClient = self._container_client()
+
+        for f in filelist:
+            source: Path = f["filepath"]
+
+            if not source.is_file():
+                raise FileNotFoundError(f"Source {source} is not a file.")
+
+            blob_name: str = f"{subpath}/{source.name}"
+
+            with open(source, "rb") as data:
+                try:
+                    container_client.upload_blob(
+                        name=blob_name, data=data, overwrite=overwrite
+                    )
+                except Exception as error:
+                    raise UploadError(f"Upload of {source.name} failed: {error}")
+
+    def close(self) -> None:
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+            self._exists = None
+
+
 def upload_files(
     filelist: List[Dict],
     container: str,
     subpath: str,
     overwrite: bool = False,
 ) -> None:
-    # Instantiate a ContainerClient directly
-    container_client = ContainerClient.from_connection_string(
-        os.getenv("AZURE_STORAGE_CONNECTION_STRING"), container
-    )
-
-    if not container_client.exists():
-        raise ACAError(f"No such container exists: {container}")
-
-    for f in filelist:
-        source: Path = f["filepath"]
-
-        if not source.is_file():
-            raise FileNotFoundError(f"Source {source} is not a file.")
-
-        blob_name: str = f"{subpath}/{source.name}"
-
-        with open(source, "rb") as data:
-            try:
-                container_client.upload_blob(
-                    name=blob_name, data=data, overwrite=overwrite
-                )
-            except Exception as error:
-                raise UploadError(f"Upload of {source.name} failed: {error}")
+    """Uploads the files with a new connection. Use an Uploader to upload
+    more than once."""
 
-    container_client.close()
+    with Uploader(container) as uploader:
+        uploader.upload_files(filelist, subpath, overwrite=overwrite)
@@ -0,0 +1,179 @@
+import asyncio
+import os
+import random
+from pathlib import Path
+from typing import Any, List, Dict, Optional
+
+from azure.core.exceptions import (
+    HttpResponseError,
+    ResourceExistsError,
+    ServiceRequestError,
+    ServiceResponseError,
+)
+from azure.storage.blob.aio import ContainerClient
+
+from workflows.utils import console
+from .blobstore import ACAError, UploadError
+
+# Number of blobs uploaded at the same time
+IN_FLIGHT = 8
+
+# Attempts at uploading a blob, and seconds before the first retry. The wait
+# doubles with each retry, give or take a random half to spread them out.
+ATTEMPTS = 4
+BACKOFF_SECONDS = 1.0
+
+# Status-codes of failed requests that are worth retrying
+RETRY_STATUS_CODES = [408, 429, 500, 502, 503, 504]
+
+
+def _retryable(error: Exception) -> bool:
+    """Returns True if an upload that failed with error may succeed if retried"""
+
+    if isinstance(error, HttpResponseError):
+        return error.status_code in RETRY_STATUS_CODES
+    return isinstance(
+        error, (ServiceRequestError, ServiceResponseError, asyncio.TimeoutError)
+    )
+
+
+class Uploader:
+    """Uploads files to a container concurrently, for a whole job. Like
+    blobstore.Uploader, but at most in_flight blobs are uploaded at a time,
+    from any number of calls to upload_files().
+
+    Failed uploads of a blob are retried with backoff, when the error may be
+    temporary. The retries of the SDK are turned off, so they don't add up.
+    Use as an async context-manager, or await close() when done.
+    """
+
+    def __init__(
+        self,
+        container: str,
+        in_flight: int = IN_FLIGHT,
+        connection_string: Optional[str] = None,
+    ):
+        self.container: str = container
+        self.in_flight: int = max(in_flight, 1)
+        self._connection_string: Optional[str] = connection_string or os.getenv(
+            "AZURE_STORAGE_CONNECTION_STRING"
+        )
+        self._client: Optional[ContainerClient] = None
+        self._exists: Optional[bool] = None
+        # Created on first use, in the event-loop of the job
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def __aenter__(self) -> "Uploader":
+        return self
+
+    async def __aexit__(self, *args: Any) -> None:
+        await self.close()
+
+    async def _container_client(self) -> ContainerClient:
+        lock: asyncio.Lock = self._lock or asyncio.Lock()
+        self._lock = lock
+
+        # Only the first of the concurrent calls checks the container
+        async with lock:
+            if not self._connection_string:
+                raise ACAError("No connection string for the storage account")
+            if self._client is None:
+                self._client = ContainerClient.from_connection_string(
+                    self._connection_string, self.container, retry_total=0
+                )
+            if self._exists is None:
+                self._exists = await self._client.exists()
+        if not self._exists:
+            raise ACAError(f"No such container exists: {self.container}")
+        return self._client
+
+    async def _upload_blob(
+        self,
+        container_client: ContainerClient,
+        slots: asyncio.Semaphore,
+        source: Path,
+        blob_name: str,
+        overwrite: bool,
+    ) -> None:
+        for attempt in range(ATTEMPTS):
+            try:
+                async with slots:
+                    with open(source, "rb") as data:
+                        await container_client.upload_blob(
+                            name=blob_name, data=data, overwrite=overwrite
+                        )
+                return
+            except ResourceExistsError as error:
+                # "BlobAlreadyExists" is checked by the callers
+                raise UploadError(
+                    f"Upload of {source.name} failed: {error.error_code or error}"
+                )
+            except Exception as error:
+                if attempt + 1 == ATTEMPTS or not _retryable(error):
+                    raise UploadError(f"Upload of {source.name} failed: {error}")
+                console.print_line(
+                    f"Retrying upload of {source.name} after error: {error}"
+                )
+            await asyncio.sleep(
+                BACKOFF_SECONDS * 2**attempt * random.uniform(0.5, 1.5)
+            )
+
+    async def upload_files(
+        self, filelist: List[Dict], subpath: str, overwrite: bool = False
+    ) -> None:
+        """Uploads the files concurrently, and returns when all of them are
+        done.
+
+        Raises
+        ------
+        FileNotFoundError
+            If one of the files does not exist. Nothing is uploaded then.
+        UploadError
+            If the upload of one of the files failed, after any retries. The
+            other files are still uploaded.
+        """
+
+        sources: List[Path] = [f["filepath"] for f in filelist]
+        for source in sources:
+            if not source.is_file():
+                raise FileNotFoundError(f"Source {source} is not a file.")
+
+        container_client: ContainerClient = await self._container_client()
+        slots: asyncio.Semaphore = self._slots or asyncio.Semaphore(self.in_flight)
+        self._slots = slots
+        results: List[Any] = await asyncio.gather(
+            *[
+                self._upload_blob(
+                    container_client,
+                    slots,
+                    source,
+                    f"{subpath}/{source.name}",
+                    overwrite,
+                )
+                for source in sources
+            ],
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+            self._exists = None
+
+
+async def upload_files(
+    filelist: List[Dict],
+    container: str,
+    subpath: str,
+    overwrite: bool = False,
+) -> None:
+    """Uploads the files concurrently with a new connection. Use an Uploader
+    to upload more than once."""
+
+    async with Uploader(container) as uploader:
+        await uploader.upload_files(filelist, subpath, overwrite=overwrite)
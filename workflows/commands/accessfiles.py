@@ -1,15 +1,657 @@
+import asyncio
 import json
+import os
 import shutil
 
 # import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
 from datetime import datetime
 from os import environ as env
-from typing import List, Dict, Union
+from queue import Queue
+from threading import Thread
+from time import perf_counter
+from typing import Any, Callable, List, Dict, Iterator, Optional, Set, Tuple, Union
 from pathlib import Path
 
 import workflows.converters as converters
-from workflows.cloud import blobstore  # blobstore2
-from workflows.utils import fileio
+from workflows.cloud import blobstore, blobstore2
+from workflows.commands import planning
+from workflows.utils import console, fileio, metrics
+from workflows.utils.cache import ConversionCache
+from workflows.utils.journal import Journal
+from workflows.utils.prefetch import Prefetcher
+
+# Number of converted rows allowed to wait for the upload-stage, before the
+# conversion-stage is held back
+UPLOAD_QUEUE_SIZE = 8
+
+# Number of masters staged by the prefetcher beyond the rows being converted
+PREFETCH_AHEAD = 4
+
+
+def _cached(
+    settings: Dict[str, Any],
+    data: Dict,
+    filepath: Path,
+    converter: str,
+    params: Dict[str, Any],
+    out_files: List[Path],
+    convert: Callable[[], Any],
+) -> List[Path]:
+    """Fetches out_files from the conversion-cache, if the master has been
+    converted with the same converter and params before. Otherwise calls
+    convert() to generate out_files and adds them to the cache.
+
+    Raises FileExistsError like the converters, if a cached file would
+    overwrite an existing one without the overwrite-flag.
+    """
+
+    cache: Optional[ConversionCache] = settings["cache"]
+    if cache is None or not data.get("checksum"):
+        convert()
+        return out_files
+
+    # The size guards against reusing artifacts of another master, if the
+    # checksum in SAM is stale
+    params = {**params, "size": filepath.stat().st_size}
+    if not settings["no_watermark"]:
+        params = {
+            **params,
+            "watermark": [
+                env["SAM_WATERMARK_WIDTH"],
+                env["SAM_WATERMARK_HEIGHT"],
+                env["SAM_WATERMARK_WHITE"],
+                env["SAM_WATERMARK_BLACK"],
+            ],
+        }
+    key: str = cache.key(
+        data.get("checksum_algorithm", ""), data["checksum"], converter, params
+    )
+
+    if cache.fetch(key, out_files, overwrite=settings["overwrite"]):
+        console.print_line(f"Using cached {converter} of {data['filename']}")
+        return out_files
+
+    convert()
+    cache.store(key, out_files)
+    return out_files
+
+
+def _thumbnail_paths(
+    filepath: Path, out_dir: Path, thumbnails: List[Dict], extension: str
+) -> List[Path]:
+    # Same naming as the thumbnail-converters
+    return [out_dir / f"{filepath.stem}{t['suffix']}{extension}" for t in thumbnails]
+
+
+def _convert_row(
+    idx: int,
+    row: Dict,
+    files_count: int,
+    settings: Dict[str, Any],
+    staged: Optional[Path] = None,
+) -> Dict[str, Any]:
+    """Generates the access-files for a single row in the csv-file from SAM.
+
+    Runs in a worker-process when generate_sam_access_files() is called with
+    more than one worker, so it must only depend on its arguments and the
+    environment.
+
+    Parameters
+    ----------
+    idx : int
+        1-based position of the row in the csv-file
+    row : Dict
+        Row from the csv-file exported from SAM
+    files_count : int
+        Total number of rows in the csv-file. Only used for printing
+    settings : Dict[str, Any]
+        Paths, sizes, formats and flags shared by all rows
+    staged : Optional[Path]
+        Local copy of the master to read instead of the one in the
+        master-path, if it has been prefetched
+
+    Returns
+    -------
+    Dict with the idx, file_id, filename and kind of the row, its filedata
+    (None, if nothing was converted), the name of the counter to increment
+    (None, if no counter applies), the metrics of the conversion and the
+    cache-entries it used in a worker-process
+    """
+
+    metrics.begin()
+    start: float = perf_counter()
+    result: Dict[str, Any] = _generate_row(idx, row, files_count, settings, staged)
+    row_metrics: Dict[str, float] = metrics.end()
+    row_metrics["convert"] = perf_counter() - start
+
+    if result["filedata"]:
+        row_metrics["bytes_out"] = sum(
+            Path(v).stat().st_size
+            for k, v in result["filedata"].items()
+            if k not in ["oasid", "record_type"]
+        )
+    result["metrics"] = row_metrics
+
+    cache: Optional[ConversionCache] = settings["cache"]
+    result["cache"] = cache.drain() if cache else []
+    return result
+
+
+def _generate_row(
+    idx: int,
+    row: Dict,
+    files_count: int,
+    settings: Dict[str, Any],
+    staged: Optional[Path] = None,
+) -> Dict[str, Any]:
+    """Does the work of _convert_row(), while its metrics are recorded"""
+
+    # Initialize vars
+    file_id: str = row["uniqueID"]
+    data = json.loads(row["oasDataJsonEncoded"])
+    no_watermark: bool = settings["no_watermark"]
+    overwrite: bool = settings["overwrite"]
+    result: Dict[str, Any] = {
+        "idx": idx,
+        "file_id": file_id,
+        "filename": data.get("filename"),
+        "kind": None,
+        "filedata": None,
+        "counter": None,
+    }
+
+    if not data.get("filename"):
+        console.print_line(f"The metadata does not contain a digital file: {file_id}")
+        return result
+    filename: str = data["filename"]
+    out_dir = settings["access_path"] / file_id
+    out_dir.mkdir(exist_ok=True)
+    filedata: Dict[str, Union[str, Path]] = {"oasid": file_id}
+    thumbs: List[Path] = []
+
+    console.print_line(f"Processing {idx} of {files_count}: {filename}")
+
+    # Check rights
+    restriction: Optional[str] = planning.restriction(data)
+    if restriction:
+        console.print_line(f"Skipping {filename} due to {restriction} restrictions")
+        result["counter"] = "convert_skipped"
+        return result
+
+    # validate filepath
+    filepath = staged or settings["master_path"] / filename
+    result["kind"] = planning.classify(filepath, settings)
+    with metrics.timed("stat"):
+        if not filepath.exists():
+            console.print_line(f"No file found at: {filepath}")
+            result["counter"] = "convert_errors"
+            return result
+        if not filepath.is_file():
+            console.print_line(f"Filepath refers to a directory: {filepath}")
+            result["counter"] = "convert_errors"
+            return result
+        size: int = filepath.stat().st_size
+    metrics.count("bytes_in", size)
+
+    # timeout around 700 secs per GB, due to M-drive limitations.
+    # AV-converters allow more time if the duration of the master needs it,
+    # and stop jobs that stall.
+    timeout: int = max(size // 1000000, 120)
+
+    # convert according to file extension
+    if filepath.suffix == ".pdf":
+        try:
+            # copy master-pdf to relevant sub-access-dir, optimized for the web
+            # if asked to
+            if settings["pdf_optimize"]:
+                _cached(
+                    settings,
+                    data,
+                    filepath,
+                    "pdf_optimize",
+                    {"dpi": settings["pdf_dpi"]},
+                    [out_dir / f"{file_id}_c.pdf"],
+                    lambda: converters.pdf_optimize(
+                        filepath,
+                        out_dir / f"{file_id}_c.pdf",
+                        dpi=settings["pdf_dpi"],
+                        overwrite=overwrite,
+                    ),
+                )
+            else:
+                with metrics.timed("copy"):
+                    shutil.copy2(filepath, out_dir / f"{file_id}_c.pdf")
+            # thumbnails
+            thumbs = _cached(
+                settings,
+                data,
+                filepath,
+                "pdf_thumbnails",
+                {"thumbnails": settings["pdf_thumbnails"]},
+                _thumbnail_paths(filepath, out_dir, settings["pdf_thumbnails"], ".jpg"),
+                lambda: converters.pdf_thumbnails(
+                    filepath,
+                    out_dir,
+                    thumbnails=settings["pdf_thumbnails"],
+                    no_watermark=no_watermark,
+                    overwrite=overwrite,
+                ),
+            )
+        except FileExistsError:
+            console.print_line(f"Skipping convertion as {filename} already exists")
+            result["counter"] = "convert_skipped"
+            return result
+        except converters.ConvertError as e:
+            console.print_line(f"ConvertError when converting pdf: {e}")
+            result["counter"] = "convert_errors"
+            return result
+        except Exception as e:
+            console.print_line(f"Unknown error when converting pdf: {e}")
+            result["counter"] = "convert_errors"
+            return result
+
+        filedata.update(
+            {
+                "record_type": "web_document",
+                "thumbnail": thumbs[0],
+                "record_image": thumbs[1],
+                "web_document_url": out_dir / f"{file_id}_c.pdf",
+            }
+        )
+
+    elif filepath.suffix in settings["audio_formats"]:
+        # Generate access copy
+        try:
+            record_file = out_dir / f"{file_id}.mp3"
+            console.print_line(
+                f"Generating access copy of audio " f"({datetime.now().time()})",
+                # f"({time.strftime('%H:%M:%S', time())})"
+            )
+            _cached(
+                settings,
+                data,
+                filepath,
+                "audio_convert",
+                {},
+                [record_file],
+                lambda: converters.audio_convert(
+                    filepath, record_file, timeout=timeout, overwrite=overwrite
+                ),
+            )
+        except FileExistsError:
+            console.print_line(f"Skipping conversion as {filename} already exists")
+            result["counter"] = "convert_skipped"
+            return result
+        except converters.ConvertError as e:
+            console.print_line(f"ConvertError converting audio: {e}")
+            result["counter"] = "convert_errors"
+            return result
+        except Exception as e:
+            console.print_line(f"Unknown error converting audio: {e}")
+            result["counter"] = "convert_errors"
+            return result
+
+        # Update filedata if all went well
+        filedata.update(
+            {
+                "record_type": "audio",
+                "record_file": record_file,
+            }
+        )
+
+    elif filepath.suffix in settings["video_formats"]:
+        # Generate access copy and thumbnails, reading the master once
+        try:
+            record_file = out_dir / f"{file_id}.mp4"
+            console.print_line(
+                f"Generating access copy and thumbs of video "
+                f"({datetime.now().time()})",
+                # f"({time.strftime('%H:%M:%S', time())})"
+            )
+            thumbs = _cached(
+                settings,
+                data,
+                filepath,
+                "video_convert_thumbnails",
+                {
+                    "quality": settings["video_quality"],
+                    "thumbnails": settings["video_thumbnails"],
+                },
+                [record_file]
+                + _thumbnail_paths(
+                    filepath, out_dir, settings["video_thumbnails"], ".png"
+                ),
+                lambda: converters.video_convert_thumbnails(
+                    filepath,
+                    record_file,
+                    out_dir,
+                    thumbnails=settings["video_thumbnails"],
+                    timeout=timeout,
+                    quality=settings["video_quality"],
+                    no_watermark=no_watermark,
+                    overwrite=overwrite,
+                    # Segments read the master about twice, so only
+                    # local copies are transcoded in segments
+                    segments=0 if staged else 1,
+                    cpu_budget=settings["cpu_budget"],
+                ),
+            )[1:]
+        except FileExistsError:
+            console.print_line(f"Skipping conversion as {filename} already exists")
+            result["counter"] = "convert_skipped"
+            return result
+        except converters.ConvertError as e:
+            console.print_line(f"ConvertError converting video: {e}")
+            result["counter"] = "convert_errors"
+            return result
+        except Exception as e:
+            console.print_line(f"Unknown error converting video: {e}")
+            result["counter"] = "convert_errors"
+            return result
+
+        # Update filedata if all went well
+        filedata.update(
+            {
+                "record_type": "video",
+                "thumbnail": thumbs[0],
+                "record_image": thumbs[1],
+                "record_file": record_file,
+            }
+        )
+
+    elif filepath.suffix in settings["image_formats"]:
+        try:
+            thumbs = _cached(
+                settings,
+                data,
+                filepath,
+                "image_thumbnails",
+                {"thumbnails": settings["image_thumbnails"]},
+                _thumbnail_paths(
+                    filepath, out_dir, settings["image_thumbnails"], ".jpg"
+                ),
+                lambda: converters.image_thumbnails(
+                    filepath,
+                    out_dir,
+                    thumbnails=settings["image_thumbnails"],
+                    no_watermark=no_watermark,
+                    overwrite=overwrite,
+                ),
+            )
+        except FileExistsError:
+            console.print_line(f"Skipping convertion as {filename} already exists")
+            result["counter"] = "convert_skipped"
+            return result
+        except converters.ConvertError as e:
+            console.print_line(f"ConvertError converting image: {e}")
+            result["counter"] = "convert_errors"
+            return result
+        except Exception as e:
+            console.print_line(f"Exception raised when converting image: {e}")
+            result["counter"] = "convert_errors"
+            return result
+
+        filedata.update(
+            {
+                "record_type": "image",
+                "thumbnail": thumbs[0],
+                "record_image": thumbs[1],
+                "large_image": thumbs[2],
+            }
+        )
+
+    else:
+        console.print_line(f"Unable to handle fileformat: {filename}")
+        result["counter"] = "convert_errors"
+        return result
+
+    result["filedata"] = filedata
+    return result
+
+
+def _convert_rows(
+    rows: List[Tuple[int, Dict]],
+    files_count: int,
+    settings: Dict[str, Any],
+    workers: int = 1,
+    prefetcher: Optional[Prefetcher] = None,
+) -> Iterator[Dict[str, Any]]:
+    """Yields the result of _convert_row() for each (idx, row) in rows. With
+    one worker, the rows are converted in order in this process. With more,
+    they are converted in a pool of processes and yielded as they finish.
+    Masters staged by the prefetcher are released once their row has been
+    converted."""
+
+    def staged(idx: int) -> Optional[Path]:
+        return prefetcher.get(idx) if prefetcher else None
+
+    def release(idx: int) -> None:
+        if prefetcher:
+            prefetcher.release(idx)
+
+    if workers <= 1:
+        for idx, row in rows:
+            result = _convert_row(idx, row, files_count, settings, staged(idx))
+            release(idx)
+            yield result
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Only submit a couple of rows per worker ahead of the consumer, so a
+        # slow consumer (the upload-stage) holds back the conversions instead
+        # of letting finished access-files pile up. Results are yielded as
+        # they finish, so a large master does not hold up the ones after it.
+        pending: Dict[Future, int] = {}
+
+        def finished() -> Iterator[Dict[str, Any]]:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                release(pending.pop(future))
+                yield result
+
+        for idx, row in rows:
+            future: Future = executor.submit(
+                _convert_row, idx, row, files_count, settings, staged(idx)
+            )
+            pending[future] = idx
+            if len(pending) >= workers * 2:
+                yield from finished()
+
+        while pending:
+            yield from finished()
+
+
+async def _upload_row(
+    filedata: Dict,
+    filename: str,
+    settings: Dict[str, Any],
+    uploader: blobstore2.Uploader,
+) -> Optional[str]:
+    """Uploads the access-files in filedata to Azure through the uploader of
+    the job, and replaces their local paths in filedata with the online urls.
+
+    Returns the name of the counter to increment, if the upload was skipped
+    or failed.
+
+    Raises
+    ------
+    ACAError
+        If the uploads of the whole job fail, e.g. if the container does not
+        exist
+    """
+
+    file_id: str = filedata["oasid"]
+    overwrite: bool = settings["overwrite"]
+
+    # if dryrun, upload to "test"-folder
+    # dest_dir = Path(env["ACASTORAGE_ROOT"])
+    # if dryrun:
+    #     dest_dir = dest_dir / "test" / file_id
+    # else:
+    #     dest_dir = dest_dir / env["ACASTORAGE_CONTAINER"] / file_id
+
+    root: str = settings["storage_root"]
+    container: str = uploader.container
+
+    keys: List = []
+    if filedata["record_type"] == "web_document":
+        keys = ["thumbnail", "record_image", "web_document_url"]
+    elif filedata["record_type"] == "video":
+        keys = ["thumbnail", "record_image", "record_file"]
+    elif filedata["record_type"] == "audio":
+        keys = ["record_file"]
+    else:
+        keys = ["thumbnail", "record_image", "large_image"]
+
+    paths: List[Dict] = []
+    for k, v in filedata.items():
+        if k in keys:
+            paths.append({"filepath": Path(v)})
+
+    try:
+        console.print_line(f"Uploading accessfiles for {filename}...")
+        await uploader.upload_files(paths, subpath=file_id, overwrite=overwrite)
+
+        # update filedata with online paths
+        # no urlencode necessary due to int-based filenames
+        for k in keys:
+            name: str = Path(filedata[k]).name
+            filedata[k] = f"{root}/{container}/{file_id}/{name}"
+
+    # except blobstore.UploadError as e:
+    except blobstore.UploadError as e:
+        if not overwrite and "BlobAlreadyExists" in str(e):
+            console.print_line(f"Aborting upload.{filename} already exists")
+            return "upload_skipped"
+        else:
+            console.print_line(f"Failed to upload {filename}: {e}")
+            return "upload_errors"
+    except blobstore.ACAError:
+        raise
+    except Exception as e:
+        console.print_line(f"Failed to upload {filename}: {e}")
+        return "upload_errors"
+
+    return None
+
+
+async def _upload_rows_async(
+    uploads: Queue,
+    settings: Dict[str, Any],
+    counters: Counter,
+    journal: Journal,
+    writer: fileio.SamCsvWriter,
+    report: metrics.Report,
+    failures: List[Exception],
+) -> None:
+    container: str = "test" if settings["dryrun"] else "sam-access"
+    concurrency: int = settings["upload_concurrency"]
+
+    # Rows are only taken from the queue when there is room for them, so the
+    # conversion-stage is still held back by a slow upload
+    rows = asyncio.Semaphore(concurrency)
+
+    async def upload(
+        uploader: blobstore2.Uploader, idx: int, filename: str, filedata: Dict
+    ) -> None:
+        try:
+            counter: Optional[str] = "upload_errors"
+            try:
+                start: float = perf_counter()
+                counter = await _upload_row(filedata, filename, settings, uploader)
+                report.add(idx, {"upload": perf_counter() - start})
+
+                # Failed uploads are retried when the job is resumed. Uploads
+                # skipped because the blobs already exist would just be
+                # skipped again.
+                if counter != "upload_errors":
+                    journal.finished(idx, filename, filedata)
+            except blobstore.ACAError as e:
+                console.print_line(f"Failed to upload {filename}: {e}")
+                counter = "upload_errors"
+                failures.append(e)
+            except Exception as e:
+                console.print_line(f"Failed to upload {filename}: {e}")
+                counter = "upload_errors"
+
+            # The row is written either way, with the local paths of the
+            # access-files if the upload failed
+            if counter:
+                counters[counter] += 1
+            writer.write(idx, filedata)
+        except Exception as e:
+            console.print_line(f"Failed to write {filename} to the csv-file: {e}")
+        finally:
+            rows.release()
+
+    async with blobstore2.Uploader(container, in_flight=concurrency) as uploader:
+        pending: Set[asyncio.Task] = set()
+        while True:
+            await rows.acquire()
+            item = await asyncio.to_thread(uploads.get)
+            if item is None:
+                break
+            # Once the uploads of the job fail, the rows are only taken off
+            # the queue, until the conversion-stage stops
+            if failures:
+                rows.release()
+                continue
+
+            task: asyncio.Task = asyncio.create_task(upload(uploader, *item))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+
+        if pending:
+            await asyncio.wait(pending)
+
+
+def _upload_rows(
+    uploads: Queue,
+    settings: Dict[str, Any],
+    counters: Counter,
+    journal: Journal,
+    writer: fileio.SamCsvWriter,
+    report: metrics.Report,
+    failures: List[Exception],
+) -> None:
+    """Upload-stage of generate_sam_access_files(). Uploads the rows put on the
+    queue, until None is put on it, and writes them to the output csv-file.
+
+    Up to settings["upload_concurrency"] rows, and as many files, are
+    uploaded at a time, over the same connection to the container. Rows are
+    written as their uploads finish, also if their upload failed. Errors that
+    fail the uploads of the whole job, like a missing container, are appended
+    to failures, and the conversion-stage must stop when there are any.
+    """
+
+    asyncio.run(
+        _upload_rows_async(
+            uploads, settings, counters, journal, writer, report, failures
+        )
+    )
+
+
+def _print_report(report: metrics.Report) -> None:
+    """Prints where the time went for each kind of master"""
+
+    for kind, summary in report.summary().items():
+        seconds: Dict[str, float] = summary["seconds"]
+        stages: str = ", ".join(
+            f"{k} {v:.1f}s" for k, v in sorted(seconds.items(), key=lambda x: -x[1])
+        )
+        not_converted: str = (
+            f", {summary['not_converted']} not converted"
+            if summary["not_converted"]
+            else ""
+        )
+        print(
+            f"{kind}: {summary['rows']} converted{not_converted}, "
+            f"{summary['convert_mb_per_second']:.2f} MB/s. {stages}",
+            flush=True,
+        )
 
 
 def generate_sam_access_files(
@@ -19,6 +661,14 @@ def generate_sam_access_files(
     local: bool = False,
     overwrite: bool = False,
     dryrun: bool = False,
+    workers: int = 1,
+    resume: bool = False,
+    cache_size: int = 10,
+    prefetch_size: int = 2,
+    plan_only: bool = False,
+    pdf_optimize: bool = False,
+    pdf_dpi: int = 0,
+    upload_concurrency: int = blobstore2.IN_FLIGHT,
 ) -> None:
     """Generates, uploads and copies access-copies of the files in the
     csv-file.
@@ -39,6 +689,28 @@ def generate_sam_access_files(
     dryrun: bool
         Fetch and save files and csv from local 'Downloads' folder. Defaults to
         False
+    workers: int
+        Number of processes converting files in parallel. Defaults to 1
+    resume: bool
+        Resume an interrupted job from the journal next to csv_out, skipping
+        the rows that were already finished. Defaults to False
+    cache_size: int
+        Size in GB of the local cache of access-files, reused when the same
+        master is converted again. 0 disables the cache. Defaults to 10
+    prefetch_size: int
+        Size in GB of the masters copied to local scratch ahead of their
+        conversion. 0 disables prefetching. Defaults to 2
+    plan_only: bool
+        Only check the rows and print the plan with an estimated duration,
+        without converting anything. Defaults to False
+    pdf_optimize: bool
+        Compress and linearize the access-copies of pdf-files for the web,
+        instead of copying the masters as they are. Defaults to False
+    pdf_dpi: int
+        Downsample images in optimized pdf-files to this resolution. 0 keeps
+        their resolution. Defaults to 0
+    upload_concurrency: int
+        Number of files uploaded at the same time. Defaults to 8
     """
 
     # Testing
@@ -47,6 +719,14 @@ def generate_sam_access_files(
     print(f"Undlad at uploade filer: {local}", flush=True)
     print(f"Overskriv eksisterende accessfiler: {overwrite}", flush=True)
     print(f"Kør som test run: {dryrun}", flush=True)
+    print(f"Antal processer: {workers}", flush=True)
+    print(f"Genoptag afbrudt kørsel: {resume}", flush=True)
+    print(f"Størrelse af cache (GB): {cache_size}", flush=True)
+    print(f"Størrelse af prefetch (GB): {prefetch_size}", flush=True)
+    print(f"Kun planlægning: {plan_only}", flush=True)
+    print(f"Optimér pdf-filer: {pdf_optimize}", flush=True)
+    print(f"Opløsning af billeder i pdf-filer (dpi): {pdf_dpi}", flush=True)
+    print(f"Samtidige uploads: {upload_concurrency}", flush=True)
     print("", flush=True)
 
     ################
@@ -89,329 +769,216 @@ def generate_sam_access_files(
     VIDEO_FORMATS = env["SAM_VIDEO_FORMATS"].split(" ")
     AUDIO_FORMATS = env["SAM_AUDIO_FORMATS"].split(" ")
 
+    # Root-url of the uploaded access-files
+    STORAGE_ROOT: str = env.get("ACASTORAGE_ROOT", "")
+    if not local and not STORAGE_ROOT:
+        raise Exception("ACASTORAGE_ROOT is not configured. Uploads are not possible")
+
+    # Artifacts are cached across jobs, so the cache is kept outside TEMP_PATH
+    cache: Optional[ConversionCache] = None
+    if cache_size > 0:
+        cache = ConversionCache(
+            Path.home() / env["APP_DIR"] / "cache", cache_size * 1000**3
+        )
+        cache.evict()
+
+    # Shared by all rows. Must be picklable, as it is passed to the workers
+    settings: Dict[str, Any] = {
+        "master_path": MASTER_PATH,
+        "access_path": ACCESS_PATH,
+        "image_formats": IMAGE_FORMATS,
+        "video_formats": VIDEO_FORMATS,
+        "audio_formats": AUDIO_FORMATS,
+        "image_thumbnails": [
+            {"size": ACCESS_SMALL_SIZE, "suffix": "_s"},
+            {"size": ACCESS_MEDIUM_SIZE, "suffix": "_m"},
+            {"size": ACCESS_LARGE_SIZE, "suffix": "_l"},
+        ],
+        "pdf_thumbnails": [
+            {"size": 150, "suffix": "_s"},
+            {"size": 640, "suffix": "_m"},
+        ],
+        "video_thumbnails": [
+            {"size": 150, "suffix": "_s"},
+            {"size": 640, "suffix": "_m"},
+        ],
+        "video_quality": 30,
+        "pdf_optimize": pdf_optimize,
+        "pdf_dpi": pdf_dpi,
+        "upload_concurrency": max(upload_concurrency, 1),
+        # Share the cpus between the workers, when transcoding long videos in
+        # segments
+        "cpu_budget": max((os.cpu_count() or 1) // max(workers, 1), 1),
+        "cache": cache,
+        "no_watermark": no_watermark,
+        "overwrite": overwrite,
+        "dryrun": dryrun,
+        "storage_root": STORAGE_ROOT,
+    }
+
     # Load csv-file from SAM
     files: List[Dict] = fileio.load_csv_from_sam(csv_in)
     files_count: int = len(files)
     print(f"Csv-file loaded. {files_count} files to process.", flush=True)
 
+    if plan_only:
+        planning.print_plan(
+            planning.plan_rows(list(enumerate(files, start=1)), settings), workers
+        )
+        shutil.rmtree(TEMP_PATH)
+        return
+
+    # Every converted and uploaded row is recorded in the journal, so an
+    # interrupted job can be resumed
+    journal = Journal(Journal.path_for(csv_out), resume=resume)
+    journal.check_source(csv_in, [row["uniqueID"] for row in files])
+    journaled: Dict[str, str] = journal.states()
+    if journaled:
+        print(f"{len(journaled)} files found in the journal.", flush=True)
+
+    # Rows are written to the partial output csv-file as soon as they are
+    # done, including the rows finished by an interrupted job, and put in
+    # input order when the job is done
+    writer = fileio.SamCsvWriter(csv_out)
+    for idx, filedata in journal.output():
+        writer.write(idx, filedata)
+
     # Initialize vars
-    convert_errors: int = 0
-    upload_errors: int = 0
-    convert_skipped: int = 0
-    upload_skipped: int = 0
-    output: List[Dict] = []
+    counters: Counter = Counter()
+    upload_counters: Counter = Counter()
+    report = metrics.Report()
+    rows: List[Tuple[int, Dict]] = [
+        (idx, row)
+        for idx, row in enumerate(files, start=1)
+        if row["uniqueID"] not in journaled
+    ]
+
+    # Check and estimate all rows up front. With several workers, the most
+    # expensive rows go first, so they don't end up as stragglers.
+    plan: List[Dict[str, Any]] = planning.plan_rows(rows, settings)
+    if workers > 1:
+        plan = planning.largest_first(plan)
+    planning.print_plan(plan, workers)
+    rows = [(entry["idx"], entry["row"]) for entry in plan]
+
+    # Copy the masters of the next rows from the M-drive to TEMP_PATH, while
+    # the current ones convert
+    prefetcher: Optional[Prefetcher] = None
+    if prefetch_size > 0:
+        masters: List[Tuple[int, Path]] = [
+            (entry["idx"], entry["path"]) for entry in plan if entry["status"] == "ok"
+        ]
+        prefetcher = Prefetcher(
+            masters,
+            TEMP_PATH / "masters",
+            max_files=workers * 2 + PREFETCH_AHEAD,
+            max_bytes=prefetch_size * 1000**3,
+        )
+        prefetcher.start()
+
+    # Upload access-files in a separate thread if "local" option not checked,
+    # so the upload of a row overlaps the conversion of the next ones
+    uploads: Queue = Queue(maxsize=UPLOAD_QUEUE_SIZE)
+    upload_failures: List[Exception] = []
+    uploader = Thread(
+        target=_upload_rows,
+        args=(
+            uploads,
+            settings,
+            upload_counters,
+            journal,
+            writer,
+            report,
+            upload_failures,
+        ),
+        daemon=True,
+    )
+
+    def upload(item: Tuple[int, str, Dict]) -> None:
+        # Blocks while the upload-stage is UPLOAD_QUEUE_SIZE rows behind. Stop
+        # converting once the uploads of the job fail.
+        if upload_failures:
+            raise Exception(f"Stopped the job as uploads failed: {upload_failures[0]}")
+        uploads.put(item)
+
+    if not local:
+        uploader.start()
 
     # Generate access-files
-    for idx, row in enumerate(files, start=1):
-        # Initialize vars
-        file_id: str = row["uniqueID"]
-        data = json.loads(row["oasDataJsonEncoded"])
-        legal_status: str = data.get("other_restrictions", "4")
-        contractual_status: str = data.get("contractual_status", "1")
-
-        if not data.get("filename"):
-            print(
-                f"The metadata does not contain a digital file: {file_id}",
-                flush=True,
-            )
-            continue
-        filename: str = data["filename"]
-        out_dir = ACCESS_PATH / file_id
-        Path(ACCESS_PATH / file_id).mkdir(exist_ok=True)
-        filedata: Dict[str, Union[str, Path]] = {"oasid": file_id}
-        thumbs: List[Path] = []
-
-        print(f"Processing {idx} of {files_count}: {filename}", flush=True)
-
-        # Check rights
-        if int(legal_status.split(";")[0]) > 1:
-            print(f"Skipping {filename} due to legal restrictions", flush=True)
-            convert_skipped += 1
-            continue
-        if int(contractual_status.split(";")[0]) < 3:
-            print(
-                f"Skipping {filename} due to contractual restrictions",
-                flush=True,
-            )
-            convert_skipped += 1
-            continue
-
-        # validate filepath
-        filepath = MASTER_PATH / filename
-        if not filepath.exists():
-            print(f"No file found at: {filepath}", flush=True)
-            convert_errors += 1
-            continue
-        if not filepath.is_file():
-            print(f"Filepath refers to a directory: {filepath}", flush=True)
-            convert_errors += 1
-            continue
-
-        # timeout around 700 secs per GB, due to M-drive limitations.
-        # Used by AV-converters
-        timeout: int = max(filepath.stat().st_size // 1000000, 120)
-
-        # convert according to file extension
-        if filepath.suffix == ".pdf":
-            try:
-                # copy master-pdf to relevant sub-access-dir
-                shutil.copy2(filepath, out_dir / f"{file_id}_c.pdf")
-                # thumbnails
-                thumbs = converters.pdf_thumbnails(
-                    filepath,
-                    out_dir,
-                    no_watermark=no_watermark,
-                    overwrite=overwrite,
-                )
-            except FileExistsError:
-                print(
-                    f"Skipping convertion as {filename} already exists",
-                    flush=True,
-                )
-                convert_skipped += 1
-                continue
-            except converters.ConvertError as e:
-                print(f"ConvertError when converting pdf: {e}", flush=True)
-                convert_errors += 1
-                continue
-            except Exception as e:
-                print(f"Unknown error when converting pdf: {e}", flush=True)
-                convert_errors += 1
-                continue
-
-            filedata.update(
+    try:
+        # Converted rows from an interrupted job only need to be uploaded
+        for unfinished in journal.unfinished():
+            if local:
+                writer.write(unfinished[0], unfinished[2])
+            else:
+                upload(unfinished)
+
+        for result in _convert_rows(
+            rows, files_count, settings, workers=workers, prefetcher=prefetcher
+        ):
+            if result["counter"]:
+                counters[result["counter"]] += 1
+            report.add(
+                result["idx"],
                 {
-                    "record_type": "web_document",
-                    "thumbnail": thumbs[0],
-                    "record_image": thumbs[1],
-                    "web_document_url": out_dir / f"{file_id}_c.pdf",
-                }
+                    "kind": result["kind"],
+                    "converted": result["filedata"] is not None,
+                    **result["metrics"],
+                },
             )
 
-        elif filepath.suffix in AUDIO_FORMATS:
-            # Generate access copy
-            try:
-                record_file = out_dir / f"{file_id}.mp3"
-                print(
-                    f"Generating access copy of audio " f"({datetime.now().time()})"
-                    # f"({time.strftime('%H:%M:%S', time())})"
-                    f". Allocated seconds: {timeout}",
-                    flush=True,
-                )
-                converters.audio_convert(
-                    filepath, record_file, timeout=timeout, overwrite=overwrite
-                )
-            except FileExistsError:
-                print(
-                    f"Skipping conversion as {filename} already exists",
-                    flush=True,
-                )
-                convert_skipped += 1
-                continue
-            except converters.ConvertError as e:
-                print(f"ConvertError converting audio: {e}", flush=True)
-                convert_errors += 1
-                continue
-            except Exception as e:
-                print(f"Unknown error converting audio: {e}", flush=True)
-                convert_errors += 1
-                continue
+            # Index the cache-entries used by the workers, which keeps the
+            # cache within its size while the job runs
+            if cache:
+                cache.record(result["cache"])
 
-            # Update filedata if all went well
-            filedata.update(
-                {
-                    "record_type": "audio",
-                    "record_file": record_file,
-                }
-            )
-
-        elif filepath.suffix in VIDEO_FORMATS:
-            # Generate access copy
-            try:
-                record_file = out_dir / f"{file_id}.mp4"
-                print(
-                    f"Generating access copy of video " f"({datetime.now().time()})"
-                    # f"({time.strftime('%H:%M:%S', time())})"
-                    f". Allocated seconds: {timeout}",
-                    flush=True,
-                )
-                converters.video_convert(
-                    filepath, record_file, timeout=timeout, overwrite=overwrite
-                )
-            except FileExistsError:
-                print(
-                    f"Skipping conversion as {filename} already exists",
-                    flush=True,
-                )
-                convert_skipped += 1
-                continue
-            except converters.ConvertError as e:
-                print(f"ConvertError converting video: {e}", flush=True)
-                convert_errors += 1
-                continue
-            except Exception as e:
-                print(f"Unknown error converting video: {e}", flush=True)
-                convert_errors += 1
+            converted: Optional[Dict] = result["filedata"]
+            if converted is None:
                 continue
 
-            # if that went well, generate thumbnails
-            try:
-                print("Generating thumbs from video...", flush=True)
-                thumbs = converters.video_thumbnails(
-                    filepath,
-                    out_dir,
-                    no_watermark=no_watermark,
-                    overwrite=overwrite,
-                )
-            except FileExistsError:
-                print(
-                    f"Skipping thumb generation as {filename} already exists",
-                    flush=True,
-                )
-                convert_skipped += 1
-                continue
-            except converters.ConvertError as e:
-                print(
-                    f"ConvertError generating thumbnails from video: {e}",
-                    flush=True,
-                )
-                convert_errors += 1
-                continue
-            except Exception as e:
-                print(
-                    f"Unknown error generating thumbnails from video: {e}",
-                    flush=True,
-                )
-                convert_errors += 1
-                continue
-
-            # Update filedata if all went well
-            filedata.update(
-                {
-                    "record_type": "video",
-                    "thumbnail": thumbs[0],
-                    "record_image": thumbs[1],
-                    "record_file": record_file,
-                }
-            )
-
-        elif filepath.suffix in IMAGE_FORMATS:
-            try:
-                thumbs = converters.image_thumbnails(
-                    filepath,
-                    out_dir,
-                    thumbnails=[
-                        {"size": ACCESS_SMALL_SIZE, "suffix": "_s"},
-                        {"size": ACCESS_MEDIUM_SIZE, "suffix": "_m"},
-                        {"size": ACCESS_LARGE_SIZE, "suffix": "_l"},
-                    ],
-                    no_watermark=no_watermark,
-                    overwrite=overwrite,
-                )
-            except FileExistsError:
-                print(
-                    f"Skipping convertion as {filename} already exists",
-                    flush=True,
-                )
-                convert_skipped += 1
-                continue
-            except converters.ConvertError as e:
-                print(f"ConvertError converting image: {e}", flush=True)
-                convert_errors += 1
-                continue
-            except Exception as e:
-                print(f"Exception raised when converting image: {e}", flush=True)
-                convert_errors += 1
-                continue
-
-            filedata.update(
-                {
-                    "record_type": "image",
-                    "thumbnail": thumbs[0],
-                    "record_image": thumbs[1],
-                    "large_image": thumbs[2],
-                }
-            )
-
-        else:
-            print(f"Unable to handle fileformat: {filename}", flush=True)
-            convert_errors += 1
-            continue
-
-        # Upload access-files if "local" option not checked
-        if not local:
-            # if dryrun, upload to "test"-folder
-            # dest_dir = Path(env["ACASTORAGE_ROOT"])
-            # if dryrun:
-            #     dest_dir = dest_dir / "test" / file_id
-            # else:
-            #     dest_dir = dest_dir / env["ACASTORAGE_CONTAINER"] / file_id
-
-            root: str = env["ACASTORAGE_ROOT"]
-            container: str = "test" if dryrun else "sam-access"
-
-            keys: List = []
-            if filedata["record_type"] == "web_document":
-                keys = ["thumbnail", "record_image", "web_document_url"]
-            elif filedata["record_type"] == "video":
-                keys = ["thumbnail", "record_image", "record_file"]
-            elif filedata["record_type"] == "audio":
-                keys = ["record_file"]
+            if local:
+                journal.finished(result["idx"], result["filename"], converted)
+                writer.write(result["idx"], converted)
             else:
-                keys = ["thumbnail", "record_image", "large_image"]
-
-            paths: List[Dict] = []
-            for k, v in filedata.items():
-                if k in keys:
-                    paths.append({"filepath": v})
-
-            try:
-                print(f"Uploading accessfiles for {filename}...", flush=True)
-                # await blobstore2.upload_files(paths, overwrite=overwrite)
-                blobstore.upload_files(
-                    paths, container, subpath=file_id, overwrite=overwrite
-                )
+                journal.converted(result["idx"], result["filename"], converted)
+                upload((result["idx"], result["filename"], converted))
+    finally:
+        if prefetcher:
+            prefetcher.close()
+        if not local:
+            uploads.put(None)
+            uploader.join()
+            counters.update(upload_counters)
 
-                # update filedata with online paths
-                # no urlencode necessary due to int-based filenames
-                for k in keys:
-                    name: str = Path(filedata[k]).name
-                    filedata[k] = f"{root}/{container}/{file_id}/{name}"
-
-            # except blobstore.UploadError as e:
-            except blobstore.UploadError as e:
-                if not overwrite and "BlobAlreadyExists" in str(e):
-                    print(
-                        f"Aborting upload.{filename} already exists",
-                        flush=True,
-                    )
-                    upload_skipped += 1
-                else:
-                    print(f"Failed to upload {filename}: {e}", flush=True)
-                    upload_errors += 1
-            except Exception as e:
-                print(f"Failed to upload {filename}: {e}", flush=True)
-                upload_errors += 1
+    journal.close()
 
-        output.append(filedata)
+    if cache:
+        cache.evict()
 
     ########################
     # save to SAM csv-file #
     ########################
-    if output:
+    if writer.count:
         print(f"\nFinished processing {files_count} files", flush=True)
-        print(f"{convert_skipped} files were skipped", flush=True)
-        print(f"{convert_errors} files failed processing", flush=True)
-        print(f"{upload_skipped} files skipped upload", flush=True)
-        print(f"{upload_errors} files failed upload", flush=True)
+        print(f"{counters['convert_skipped']} files were skipped", flush=True)
+        print(f"{counters['convert_errors']} files failed processing", flush=True)
+        print(f"{counters['upload_skipped']} files skipped upload", flush=True)
+        print(f"{counters['upload_errors']} files failed upload", flush=True)
+        _print_report(report)
         try:
-            fileio.save_csv_to_sam(output, csv_out)
+            writer.close()
         except Exception as e:
             print(f"Error trying to generate csv-file: {e}", flush=True)
 
     else:
+        writer.discard()
         print("No new accessfiles have been generated", flush=True)
 
+    try:
+        report.save(csv_out.with_name(f"{csv_out.stem}_report.json"))
+    except Exception as e:
+        print(f"Error trying to save the report: {e}", flush=True)
+
     # Remove temp-folder
     if TEMP_PATH.exists():
         shutil.rmtree(TEMP_PATH)
@@ -0,0 +1,148 @@
+import heapq
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, List, Dict, Optional, Tuple
+from pathlib import Path
+
+# Rough conversion cost of each kind of master, as seconds per row plus
+# seconds per MB. Reading the master from the M-drive (about 0.7 s/MB) is
+# included in the cost per MB.
+COST_PER_ROW: Dict[str, float] = {"pdf": 2.0, "image": 2.0, "audio": 3.0, "video": 10.0}
+COST_PER_MB: Dict[str, float] = {"pdf": 0.8, "image": 0.9, "audio": 1.0, "video": 3.0}
+
+# Number of threads used to stat the masters
+STAT_THREADS = 16
+
+
+def restriction(data: Dict) -> Optional[str]:
+    """Returns the kind of restriction that prevents generating access-files
+    from the metadata of a record, or None"""
+
+    legal_status: str = data.get("other_restrictions", "4")
+    contractual_status: str = data.get("contractual_status", "1")
+    if int(legal_status.split(";")[0]) > 1:
+        return "legal"
+    if int(contractual_status.split(";")[0]) < 3:
+        return "contractual"
+    return None
+
+
+def classify(filepath: Path, settings: Dict[str, Any]) -> Optional[str]:
+    """Returns the kind of master, as handled by accessfiles, or None if the
+    fileformat is not supported"""
+
+    if filepath.suffix == ".pdf":
+        return "pdf"
+    elif filepath.suffix in settings["audio_formats"]:
+        return "audio"
+    elif filepath.suffix in settings["video_formats"]:
+        return "video"
+    elif filepath.suffix in settings["image_formats"]:
+        return "image"
+    return None
+
+
+def _stat(path: Path) -> Tuple[str, int]:
+    try:
+        if not path.exists():
+            return "missing", 0
+        if not path.is_file():
+            return "directory", 0
+        return "ok", path.stat().st_size
+    except OSError:
+        return "missing", 0
+
+
+def plan_rows(
+    rows: List[Tuple[int, Dict]], settings: Dict[str, Any]
+) -> List[Dict[str, Any]]:
+    """Checks the rows of a csv-file from SAM without converting anything, and
+    estimates the cost of converting each of them. The masters are stat'ed
+    concurrently, as the M-drive is slow to answer.
+
+    Returns
+    -------
+    List of dicts with the idx, row, master-path, status ("ok", "no_file",
+    "restricted", "missing", "directory" or "unsupported"), kind, size in
+    bytes and estimated cost in seconds of each row, in the order of rows
+    """
+
+    plan: List[Dict[str, Any]] = []
+    for idx, row in rows:
+        data: Dict = json.loads(row["oasDataJsonEncoded"])
+        entry: Dict[str, Any] = {
+            "idx": idx,
+            "row": row,
+            "path": None,
+            "status": "ok",
+            "kind": None,
+            "size": 0,
+            "cost": 0.0,
+        }
+        if not data.get("filename"):
+            entry["status"] = "no_file"
+        elif restriction(data):
+            entry["status"] = "restricted"
+        else:
+            entry["path"] = settings["master_path"] / data["filename"]
+        plan.append(entry)
+
+    to_stat: List[Dict[str, Any]] = [e for e in plan if e["path"] is not None]
+    with ThreadPoolExecutor(max_workers=STAT_THREADS) as executor:
+        stats = executor.map(_stat, [e["path"] for e in to_stat])
+        for entry, (status, size) in zip(to_stat, stats):
+            entry["status"] = status
+            entry["size"] = size
+
+    for entry in to_stat:
+        if entry["status"] != "ok":
+            continue
+        kind: Optional[str] = classify(entry["path"], settings)
+        if kind is None:
+            entry["status"] = "unsupported"
+            continue
+        entry["kind"] = kind
+        entry["cost"] = COST_PER_ROW[kind] + COST_PER_MB[kind] * entry["size"] / 1e6
+
+    return plan
+
+
+def largest_first(plan: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Orders the plan by decreasing cost (longest processing time first), so
+    the largest masters do not start last and hold up the end of the job"""
+    return sorted(plan, key=lambda e: e["cost"], reverse=True)
+
+
+def makespan(plan: List[Dict[str, Any]], workers: int = 1) -> float:
+    """Estimates the seconds it takes to process the plan in the given order,
+    with each row going to the first available worker"""
+
+    finish: List[float] = [0.0] * max(workers, 1)
+    for entry in plan:
+        heapq.heapreplace(finish, finish[0] + entry["cost"])
+    return max(finish)
+
+
+def print_plan(plan: List[Dict[str, Any]], workers: int = 1) -> None:
+    """Prints a summary of the plan with an estimated time of arrival"""
+
+    print("Plan:", flush=True)
+    for kind in ["pdf", "image", "audio", "video"]:
+        entries = [e for e in plan if e["kind"] == kind]
+        if entries:
+            size: float = sum(e["size"] for e in entries) / 1e6
+            print(f"  {len(entries)} {kind} files, {size:.0f} MB", flush=True)
+    for status in ["no_file", "restricted", "missing", "directory", "unsupported"]:
+        count: int = len([e for e in plan if e["status"] == status])
+        if count:
+            print(f"  {count} rows will be skipped: {status}", flush=True)
+
+    ordered = largest_first(plan) if workers > 1 else plan
+    seconds: float = makespan(ordered, workers)
+    eta: datetime = datetime.now() + timedelta(seconds=seconds)
+    print(
+        f"Estimated duration with {workers} worker(s): "
+        f"{timedelta(seconds=round(seconds))} (done around {eta:%d-%m %H:%M})",
+        flush=True,
+    )
@@ -1,13 +1,17 @@
 from .pdf import thumbnails as pdf_thumbnails
+from .pdf import optimize as pdf_optimize
 from .image import thumbnails as image_thumbnails
 from .video import thumbnails as video_thumbnails
 from .video import convert as video_convert
+from .video import convert_with_thumbnails as video_convert_thumbnails
 from .audio import convert as audio_convert
 from .exceptions import ConvertError
 
 __all__ = [
     "pdf_thumbnails",
+    "pdf_optimize",
     "video_convert",
+    "video_convert_thumbnails",
     "audio_convert",
     "video_thumbnails",
     "image_thumbnails",
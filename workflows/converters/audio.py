@@ -1,11 +1,60 @@
 from pathlib import Path
+from typing import Any, List, Dict, Optional
 
-from workflows.utils import sp
+from . import ffmpeg, probe
 from .exceptions import ConvertError
 
 
 CMD_PATH = Path.home() / ".aca" / "workflows" / "bin" / "ffmpeg.exe"
 
+# Access-copies are encoded as mp3 with this bit rate per channel, at most
+# this many channels and this sample rate
+BIT_RATE_PER_CHANNEL = 96_000
+MAX_CHANNELS = 2
+SAMPLE_RATE = 44100
+
+# Mp3-masters within these limits are copied as they are
+MAX_COPY_BIT_RATE = 320_000
+COPY_SAMPLE_RATES = [32000, 44100, 48000]
+
+# Embedded cover-art is kept if its width and height are at most this many
+# pixels, and removed otherwise
+MAX_COVER_SIZE = 1000
+
+
+def _copyable(info: Optional[Dict[str, Any]]) -> bool:
+    """Returns True if the first audio-stream in the probed info is an mp3,
+    that can be copied as it is into the access-copy"""
+
+    if info is None or not probe.streams(info, "audio"):
+        return False
+    audio: Dict[str, Any] = probe.streams(info, "audio")[0]
+    try:
+        return (
+            audio.get("codec_name") == "mp3"
+            and int(audio.get("bit_rate", 0)) <= MAX_COPY_BIT_RATE
+            and int(audio.get("channels", 0)) <= MAX_CHANNELS
+            and int(audio.get("sample_rate", 0)) in COPY_SAMPLE_RATES
+        )
+    except ValueError:
+        return False
+
+
+def _cover_args(info: Optional[Dict[str, Any]]) -> List:
+    """Returns the ffmpeg output-options mapping the first audio-stream and,
+    if it is small enough, the cover-art in the probed info"""
+
+    args: List = ["-map", "0:a:0"]
+    if info is None:
+        return args + ["-vn"]
+    for stream in info["streams"]:
+        if stream.get("disposition", {}).get("attached_pic"):
+            width, height = stream.get("width", 0), stream.get("height", 0)
+            if max(width, height) <= MAX_COVER_SIZE:
+                return args + ["-map", f"0:{stream['index']}", "-c:v", "copy"]
+            break
+    return args + ["-vn"]
+
 
 def convert(
     in_file: Path,
@@ -13,6 +62,12 @@ def convert(
     timeout: int = 180,
     overwrite: bool = False,
 ) -> None:
+    """Generates an mp3 access-copy of an audio-master. Mp3-masters within
+    the copy-limits are copied as they are. Other masters are encoded with
+    BIT_RATE_PER_CHANNEL, at most MAX_CHANNELS and SAMPLE_RATE. Cover-art is
+    kept, unless it is larger than MAX_COVER_SIZE.
+    """
+
     if not in_file.is_file():
         raise FileNotFoundError(f"Input-path not an audio file: {in_file}")
 
@@ -25,19 +80,28 @@ def convert(
         else:
             out_file.unlink()
 
-    cmd = [
-        CMD_PATH,
-        "-loglevel",
-        "error",
-        "-i",
-        in_file,
-        out_file,
-    ]
-    try:
-        sp.run(cmd, timeout)
-    except sp.ProcessError as e:
-        raise ConvertError(f"ProcessError: {e}")
-    except sp.TimeoutError as e:
-        raise ConvertError(f"TimeoutError: {e}")
-    except Exception as e:
-        raise ConvertError(f"Unspecified error: {e}")
+    info: Optional[Dict[str, Any]] = probe.try_probe(in_file)
+    duration: Optional[float] = probe.duration(info) if info else None
+    if info and not probe.streams(info, "audio"):
+        raise ConvertError(f"No audio stream in {in_file}")
+
+    cmd: List = [CMD_PATH, "-loglevel", "error", "-i", in_file]
+    cmd += _cover_args(info)
+    if _copyable(info):
+        # Copy the mp3 as it is
+        cmd += ["-c", "copy"]
+    else:
+        audio: Dict[str, Any] = probe.streams(info, "audio")[0] if info else {}
+        channels: int = min(int(audio.get("channels", 2)), MAX_CHANNELS)
+        cmd += [
+            "-c:a",
+            "libmp3lame",
+            "-b:a",
+            f"{BIT_RATE_PER_CHANNEL * channels // 1000}k",
+            "-ac",
+            f"{channels}",
+            "-ar",
+            f"{SAMPLE_RATE}",
+        ]
+    cmd += [out_file]
+    ffmpeg.run(cmd, ffmpeg.timeout_for(duration, timeout), duration, in_file.name)
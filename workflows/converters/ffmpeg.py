@@ -0,0 +1,102 @@
+from time import monotonic
+from typing import Any, List, Dict, Optional
+
+from workflows.utils import console, metrics, sp
+from .exceptions import ConvertError
+
+
+# Slowest acceptable speed in seconds of media per second. A job is given at
+# least the duration of its media at this speed, plus STARTUP_SECONDS.
+MIN_SPEED = 0.2
+STARTUP_SECONDS = 120
+
+# Seconds a job may run without its output advancing, before it is killed.
+# Once the output has reached DONE_FRACTION of the duration, the job is only
+# killed by its timeout, as ffmpeg reports no progress while it finishes the
+# file, e.g. rewriting a whole mp4 to move its index to the front.
+STALL_SECONDS = 120
+DONE_FRACTION = 0.99
+
+# Seconds between printing the progress of a job
+REPORT_SECONDS = 60
+
+
+def timeout_for(duration: Optional[float], default: int) -> int:
+    """Returns the seconds allowed for a job on media of duration seconds.
+
+    The timeout is only a backstop, as jobs that stall are stopped by run().
+    So the job gets default, e.g. a budget by the size of the master, if that
+    is more than the duration allows. Masters with a high bitrate may take
+    longer to read than to transcode.
+    """
+
+    if not duration:
+        return default
+    return max(default, int(STARTUP_SECONDS + duration / MIN_SPEED))
+
+
+def run(
+    cmd: List, timeout: int, duration: Optional[float] = None, name: str = ""
+) -> bytes:
+    """Runs an ffmpeg-cmd, reading its progress, and returns its stdout.
+
+    The encoded time and speed of the job are printed every REPORT_SECONDS
+    and when it ends. The job is killed if it runs longer than timeout, or if
+    its output-time does not advance for STALL_SECONDS before it reaches the
+    duration.
+
+    Parameters
+    ----------
+    cmd : List
+        ffmpeg-cmd, starting with the path to ffmpeg
+    timeout : int
+        Number of seconds the job may run in total
+    duration : Optional[float]
+        Duration of the media in seconds, if known. Used when printing, and to
+        tell when the output is complete.
+    name : str
+        Name of the job when printing
+
+    Raises
+    ------
+    ConvertError
+        If ffmpeg fails, times out or stalls
+    """
+
+    watched: List = [cmd[0], "-nostats", "-progress", "pipe:2"] + cmd[1:]
+    start: float = monotonic()
+    state: Dict[str, Any] = {"out_time": -1.0, "reported": start}
+
+    def on_progress(block: Dict[str, str]) -> Optional[bool]:
+        try:
+            out_time: float = int(block.get("out_time_us", "")) / 1e6
+        except ValueError:
+            return False
+
+        advanced: bool = out_time > state["out_time"]
+        state["out_time"] = max(out_time, state["out_time"])
+        if (
+            monotonic() - state["reported"] > REPORT_SECONDS
+            or block.get("progress") == "end"
+        ):
+            # ffmpeg's own speed is unreliable in the last block
+            total: str = f" of {duration:.0f}" if duration else ""
+            speed: float = state["out_time"] / max(monotonic() - start, 0.001)
+            console.print_line(
+                f"{name}: {state['out_time']:.0f}{total} seconds encoded "
+                f"(speed {speed:.2f}x)"
+            )
+            state["reported"] = monotonic()
+        if duration and state["out_time"] >= duration * DONE_FRACTION:
+            return None
+        return advanced
+
+    try:
+        with metrics.timed("ffmpeg"):
+            return sp.run_progress(watched, timeout, STALL_SECONDS, on_progress)
+    except sp.ProcessError as e:
+        raise ConvertError(f"ProcessError: {e}")
+    except sp.TimeoutError as e:
+        raise ConvertError(f"TimeoutError: {e}")
+    except Exception as e:
+        raise ConvertError(f"Unspecified error: {e}")
@@ -1,13 +1,84 @@
+import math
 from os import environ as env
 from pathlib import Path
-from typing import Any, List, Dict, Optional
+from typing import Any, List, Dict, Iterator, Tuple
 
 import numpy as np
-from PIL import Image, ExifTags
+from PIL import ExifTags, Image, ImageOps
 
-from workflows.utils import watermark
+from workflows.utils import metrics, watermark
+from . import resize
 from .exceptions import ConvertError
 
+# Masters are trusted archival files, and scans of 200+ megapixels would
+# otherwise be refused as decompression bombs
+Image.MAX_IMAGE_PIXELS = None
+
+# Single-band, unsigned 16-bit modes, in any byte-order
+MODES_16BIT = ["I;16", "I;16L", "I;16B", "I;16N"]
+
+# Window of 16-bit values stretched to 0-255, as percentiles of all values.
+# (0, 100) is the min/max of the image.
+WINDOW_PERCENTILES = (0.0, 100.0)
+
+# Number of pixels in each strip when normalizing 16-bit images
+STRIP_PIXELS = 2**22
+
+
+def _strips(img: Any) -> Iterator[Tuple[int, Any]]:
+    """Yields the top-row and pixel-values of each horizontal strip of img"""
+
+    rows: int = max(STRIP_PIXELS // img.width, 1)
+    for top in range(0, img.height, rows):
+        strip: Any = img.crop((0, top, img.width, min(top + rows, img.height)))
+        yield top, np.asarray(strip)
+
+
+def _to_8bit(img: Any) -> Any:
+    """Returns an 8-bit version of a 16-bit image.
+
+    The values within WINDOW_PERCENTILES are stretched linearly to 0-255
+    through a lookup-table. The image is read in strips, first to build a
+    histogram and then to map each strip into the 8-bit result, so only
+    strips are copied besides the result. All bands share the same window.
+    """
+
+    # First pass: histogram of all values, giving the window
+    histogram: Any = np.zeros(2**16, dtype=np.int64)
+    for _, values in _strips(img):
+        histogram += np.bincount(values.ravel(), minlength=2**16)
+
+    cumulative: Any = np.cumsum(histogram)
+    total: int = int(cumulative[-1])
+    low: int = int(
+        np.searchsorted(cumulative, total * WINDOW_PERCENTILES[0] / 100, "right")
+    )
+    high: int = int(np.searchsorted(cumulative, total * WINDOW_PERCENTILES[1] / 100))
+    high = max(min(high, 2**16 - 1), low + 1)
+
+    lut: Any = np.arange(2**16, dtype=np.float32)
+    lut = np.clip((lut - low) * (255 / (high - low)) + 0.5, 0, 255).astype(np.uint8)
+
+    # Second pass: map each strip through the table into the result
+    mode: str = {1: "L", 3: "RGB", 4: "RGBA"}[len(img.getbands())]
+    out: Any = Image.new(mode, img.size)
+    for top, values in _strips(img):
+        out.paste(Image.fromarray(lut[values]), (0, top))
+    return out
+
+
+def draft(img: Any, size: int) -> None:
+    """Lets the JPEG-decoder scale img down (by 1/2, 1/4 or 1/8) while
+    decoding, as long as a thumbnail of size can still be made from the
+    result. Does nothing to other formats, or once img is loaded."""
+
+    scale: float = size / max(img.size)
+    if img.format == "JPEG" and scale < 1:
+        img.draft(
+            img.mode,
+            (math.ceil(img.width * scale), math.ceil(img.height * scale)),
+        )
+
 
 def thumbnails(
     in_file: Path,
@@ -19,6 +90,7 @@ def thumbnails(
     no_watermark: bool = False,
     overwrite: bool = False,
     extension: str = ".jpg",
+    memory_budget: int = resize.MEMORY_BUDGET,
 ) -> List[Path]:
     # validate
     if not in_file.is_file():
@@ -32,64 +104,68 @@ def thumbnails(
         out_dir.mkdir(parents=True, exist_ok=True)
 
     try:
-        img: Any = Image.open(in_file)
+        with metrics.timed("open"):
+            img: Any = Image.open(in_file)
+
+        # Size in the header, before any reduction while decoding
+        source_size: Tuple[int, int] = img.size
+        largest: int = max((t["size"] for t in thumbnails), default=0)
+        draft(img, largest)
+
+        with metrics.timed("decode"):
+            # Too large to decode fully. Reduce it while reading it in strips.
+            if resize.decoded_size(img) > memory_budget:
+                reduced: Any = resize.reduce_streamed(
+                    in_file, img, largest, memory_budget
+                )
+                if reduced is not None:
+                    img.close()
+                    img = reduced
+            img.load()
     except Exception as e:
         raise ConvertError(f"Error opening file {in_file}: {e}")
 
-    # Image might be rotated. Fix, if rotatet.
-    if hasattr(img, "_getexif"):  # only present in JPGs
-        # Find the orientation exif tag.
-        orientation_key: Optional[int] = None
-        for tag, tag_value in ExifTags.TAGS.items():
-            if tag_value == "Orientation":
-                orientation_key = tag
-                break
-
-        # If exif data is present, rotate image according to
-        # orientation value.
-        if img.getexif() is not None:
-            exif: Dict[Any, Any] = dict(img.getexif().items())
-            orientation: Optional[int] = exif.get(orientation_key)
-            if orientation == 3:
-                img = img.rotate(180)
-            elif orientation == 6:
-                img = img.rotate(270)
-            elif orientation == 8:
-                img = img.rotate(90)
+    # Image might be rotated or mirrored. Fix the (reduced) image according to
+    # its exif-orientation.
+    if img.getexif().get(ExifTags.Base.Orientation) in [5, 6, 7, 8]:
+        source_size = (source_size[1], source_size[0])
+    ImageOps.exif_transpose(img, in_place=True)
 
     # Tiff-challenges
-    if "16" in img.mode:
-        # https://github.com/openvinotoolkit/cvat/pull/342/commits/ \
-        # 1520641ce65c4d3d90cb1011f83603a70943f479
-        im_data = np.array(img)
-        img = Image.fromarray(im_data // (im_data.max() // 2**8))
+    if img.mode in MODES_16BIT:
+        with metrics.timed("normalize"):
+            img = _to_8bit(img)
 
     # If not rbg, convert before doing more
     if img.mode != "RGB":
         img = img.convert("RGB")
 
-    response: List[Path] = []
-    # Generate thumbnails
-    for thumb in thumbnails:
-        out_file: Path = out_dir / f"{in_file.stem}{thumb.get('suffix')}{extension}"
-
+    out_files: List[Path] = [
+        out_dir / f"{in_file.stem}{thumb.get('suffix')}{extension}"
+        for thumb in thumbnails
+    ]
+    for out_file in out_files:
         if out_file.exists() and not overwrite:
             raise FileExistsError(f"File already exists: {out_file}")
 
-        copy_img = img.copy()
-        # thumbnail() doesn't enlarge smaller img and keeps aspect-ratio
-        copy_img.thumbnail((thumb.get("size"), thumb.get("size")))
+    with metrics.timed("resize"):
+        resized: List[Any] = resize.cascade(
+            img, [t["size"] for t in thumbnails], source_size
+        )
 
-        # If larger than watermark-width, add watermark
-        if not no_watermark:
-            if copy_img.width > int(env["SAM_WATERMARK_WIDTH"]):
-                copy_img = watermark.add_watermark_to_image(copy_img)
+    # If larger than watermark-width, add watermark
+    if not no_watermark:
+        with metrics.timed("watermark"):
+            resized = watermark.add_watermark_to_images(
+                resized, min_width=int(env["SAM_WATERMARK_WIDTH"])
+            )
 
+    # Generate thumbnails
+    for out_file, copy_img in zip(out_files, resized):
         try:
-            copy_img.save(out_file)
+            with metrics.timed("encode"):
+                copy_img.save(out_file)
         except Exception as e:
             raise ConvertError(f"Error saving thumbnail from {in_file}: {e}")
 
-        response.append(out_file)
-
-    return response
+    return out_files
@@ -1,17 +1,100 @@
+import io
+import math
+import re
+import shutil
 from os import environ as env
 from pathlib import Path
-from typing import List, Dict
+from typing import Any, List, Dict, Optional
 
 import fitz
 from PIL import Image
 
-from workflows.utils import watermark
+from workflows.utils import console, metrics, watermark
+from . import image, resize
+
+
+# Formats that PyMuPDF can encode pixmaps to, and the jpeg-quality used by
+# both PyMuPDF and Pillow
+PIXMAP_FORMATS = [".jpg", ".jpeg", ".png"]
+JPEG_QUALITY = 75
+
+# Part of a page an embedded jpeg must cover, for the page to count as scanned
+SCAN_COVERAGE = 0.98
+
+# When optimizing, images are only downsampled if their resolution is this
+# many times the target dpi, as re-encoding them costs quality for little gain
+DOWNSAMPLE_THRESHOLD = 1.5
+
+# Linearization was removed from MuPDF in 1.26
+LINEARIZE = tuple(int(v) for v in fitz.VersionBind.split(".")[:2]) < (1, 26)
 
 
 class ConvertError(Exception):
     """Implements error to raise when pdf-conversion fails."""
 
 
+def _upright(contents: bytes) -> bool:
+    """Returns True if none of the transformations (cm-operators) in the
+    contents of a page rotate, skew or mirror what is drawn"""
+
+    for match in re.finditer(
+        rb"(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s+\S+\s+\S+\s+cm\b", contents
+    ):
+        try:
+            a, b, c, d = [float(v) for v in match.groups()]
+        except ValueError:
+            return False
+        if b or c or a <= 0 or d <= 0:
+            return False
+    return True
+
+
+def _scanned_page(doc: Any, pdf_page: Any, size: int) -> Optional[Any]:
+    """Returns the page as a PIL Image decoded from its embedded jpeg, if the
+    page is nothing but a single, upright jpeg covering it, like scanner
+    output. Invisible (OCR) text is allowed. The jpeg is decoded at reduced
+    size, as long as a thumbnail of size can be made from it.
+
+    Returns None if the page must be rendered instead, including when the
+    jpeg is smaller than size.
+    """
+
+    images: List = pdf_page.get_images(full=True)
+    if len(images) != 1 or pdf_page.rotation:
+        return None
+    xref, smask, width, height, _, _, _, _, filter_name, referencer = images[0]
+    if smask or referencer or filter_name != "DCTDecode" or max(width, height) < size:
+        return None
+
+    # Nothing but the image may be drawn on the page
+    drawn: List = [box for box in pdf_page.get_bboxlog() if box[0] != "ignore-text"]
+    if len(drawn) != 1 or drawn[0][0] != "fill-image":
+        return None
+
+    # The image must cover the page, upright and with its own aspect-ratio
+    page_rect: Any = pdf_page.rect
+    rect: Any = fitz.Rect(drawn[0][1])
+    if (rect & page_rect).get_area() < SCAN_COVERAGE * page_rect.get_area():
+        return None
+    if abs(rect.width / rect.height * height / width - 1) > 0.01:
+        return None
+    if not _upright(pdf_page.read_contents()):
+        return None
+
+    jpeg: bytes = doc.xref_stream_raw(xref)
+    if not jpeg.startswith(b"\xff\xd8"):
+        return None
+    try:
+        img: Any = Image.open(io.BytesIO(jpeg))
+        if img.mode not in ["RGB", "L"]:
+            return None
+        image.draft(img, size)
+        img.load()
+    except Exception:
+        return None
+    return img if img.mode == "RGB" else img.convert("RGB")
+
+
 def thumbnails(
     in_file: Path,
     out_dir: Path,
@@ -32,36 +115,197 @@ def thumbnails(
     if not out_dir.exists():
         out_dir.mkdir(parents=True, exist_ok=True)
 
+    out_files: List[Path] = [
+        out_dir / f"{in_file.stem}{thumb.get('suffix')}{extension}"
+        for thumb in thumbnails
+    ]
+    for out_file in out_files:
+        if out_file.exists() and not overwrite:
+            raise FileExistsError(f"File already exists: {out_file}")
+
     try:
-        doc = fitz.open(in_file)
+        with metrics.timed("open"):
+            doc = fitz.open(in_file)
     except Exception as e:
         raise ConvertError(f"Unable to open {in_file} as pdf-file: {e}")
 
-    pix = doc.load_page(page).get_pixmap()
-    # create and save a PIL image
-    img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-
-    response: List[Path] = []
-    for thumb in thumbnails:
-        # tests
-        out_file: Path = out_dir / f"{in_file.stem}{thumb.get('suffix')}{extension}"
-        if out_file.exists() and not overwrite:
-            raise FileExistsError(f"File already exists: {out_file}")
+    # Render the page once, so that it fits the largest thumbnail exactly
+    sizes: List[int] = [t["size"] for t in thumbnails]
+    with doc:
+        with metrics.timed("decode"):
+            pdf_page: Any = doc.load_page(page)
+            longest: float = max(pdf_page.rect.width, pdf_page.rect.height)
+            if not sizes or longest <= 0:
+                raise ConvertError(f"Nothing to render on page {page} of {in_file}")
+            # Scanned pages are decoded from their jpeg, at reduced size
+            pix: Any = None
+            img: Any = _scanned_page(doc, pdf_page, max(sizes))
+            if img is None:
+                zoom: float = max(sizes) / longest
+                pix = pdf_page.get_pixmap(
+                    matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csRGB, alpha=False
+                )
+                # Copies the samples once, from a memoryview of the pixmap.
+                # Pillow only shares buffers in modes like RGBA, and rendering
+                # with alpha would leave the page transparent, not white.
+                img = Image.frombuffer(
+                    "RGB",
+                    (pix.width, pix.height),
+                    pix.samples_mv,
+                    "raw",
+                    "RGB",
+                    pix.stride,
+                    1,
+                )
 
-        copy_img = img.copy()
-        # thumbnail() doesn't enlarge smaller img and keeps aspect-ratio
-        copy_img.thumbnail((thumb.get("size"), thumb.get("size")))
+    with metrics.timed("resize"):
+        resized: List[Any] = resize.cascade(img, sizes)
 
-        # If larger than watermark-width, add watermark
-        if not no_watermark:
-            if copy_img.width > int(env["SAM_WATERMARK_WIDTH"]):
-                copy_img = watermark.add_watermark_to_image(copy_img)
+    # If larger than watermark-width, add watermark
+    if not no_watermark:
+        with metrics.timed("watermark"):
+            resized = watermark.add_watermark_to_images(
+                resized, min_width=int(env["SAM_WATERMARK_WIDTH"])
+            )
 
+    # Generate thumbnails. The rendered size without watermark is encoded
+    # straight from the pixmap.
+    for out_file, copy_img in zip(out_files, resized):
         try:
-            copy_img.save(out_file)
+            with metrics.timed("encode"):
+                if (
+                    pix is not None
+                    and copy_img is img
+                    and out_file.suffix.lower() in PIXMAP_FORMATS
+                ):
+                    pix.save(out_file, jpg_quality=JPEG_QUALITY)
+                else:
+                    copy_img.save(out_file, quality=JPEG_QUALITY)
         except Exception as e:
             raise ConvertError(f"Error saving thumbnail from {in_file}: {e}")
 
-        response.append(out_file)
+    return out_files
+
+
+def _downsample_images(doc: Any, dpi: int) -> int:
+    """Re-encodes the 8-bit gray and rgb images of doc as jpegs of at most dpi,
+    where they are shown at DOWNSAMPLE_THRESHOLD times that or more. Images
+    with transparency, masks, fewer bits or other colorspaces (like cmyk) are
+    left as they are.
+
+    Returns
+    -------
+    The number of images replaced
+    """
+
+    # Smallest width in points that each image is shown at, and a page
+    # showing it
+    shown: Dict[int, float] = {}
+    pages: Dict[int, Any] = {}
+    for pdf_page in doc:
+        for xref, smask, _, _, bpc, *_ in pdf_page.get_images(full=True):
+            if smask or bpc != 8:
+                continue
+            for rect in pdf_page.get_image_rects(xref):
+                if rect.width > 0 and rect.width < shown.get(xref, math.inf):
+                    shown[xref] = rect.width
+                    pages[xref] = pdf_page
+
+    replaced: int = 0
+    for xref, points in shown.items():
+        pix: Any = fitz.Pixmap(doc, xref)
+        if pix.alpha or pix.n not in [1, 3]:
+            continue
+        width: int = math.ceil(points / 72 * dpi)
+        if pix.width < width * DOWNSAMPLE_THRESHOLD:
+            continue
+
+        mode: str = "L" if pix.n == 1 else "RGB"
+        img: Any = Image.frombuffer(
+            mode, (pix.width, pix.height), pix.samples_mv, "raw", mode, pix.stride, 1
+        )
+        target = (width, max(round(pix.height * width / pix.width), 1))
+        stream = io.BytesIO()
+        resize.cascade_to(img, [target])[0].save(stream, "JPEG", quality=JPEG_QUALITY)
+        # Only replace images that get smaller
+        if stream.tell() < len(doc.xref_stream_raw(xref)):
+            pages[xref].replace_image(xref, stream=stream.getvalue())
+            replaced += 1
+    return replaced
+
+
+def optimize(
+    in_file: Path, out_file: Path, dpi: int = 0, overwrite: bool = False
+) -> Path:
+    """Saves a copy of a pdf-file optimized for the web. Unused and duplicate
+    objects are removed, and streams, fonts and images are compressed. The
+    copy is linearized for fast web view, where MuPDF still supports it. If
+    the copy is no smaller than the pdf-file, the pdf-file is copied as is.
+
+    Parameters
+    ----------
+    in_file : Path
+        Path to the pdf-file
+    out_file : Path
+        Path to the optimized copy
+    dpi : int
+        Downsample images shown at a higher resolution than this, see
+        _downsample_images(). 0 leaves all images as they are. Defaults to 0
+    overwrite : bool
+        Overwrite out_file, if it exists. Defaults to False
+
+    Returns
+    -------
+    out_file
+
+    Raises
+    ------
+    FileExistsError
+        If out_file exists and overwrite is False
+    ConvertError
+        If the pdf-file cannot be read or the copy cannot be saved
+    """
+
+    if not (in_file.is_file()) or in_file.suffix != ".pdf":
+        raise FileNotFoundError(f"Input-path not a pdf-file: {in_file}")
+    if out_file.exists() and not overwrite:
+        raise FileExistsError(f"File already exists: {out_file}")
+    out_file.parent.mkdir(parents=True, exist_ok=True)
+
+    try:
+        with metrics.timed("open"):
+            doc = fitz.open(in_file)
+    except Exception as e:
+        raise ConvertError(f"Unable to open {in_file} as pdf-file: {e}")
+
+    with doc:
+        try:
+            if dpi > 0:
+                with metrics.timed("resize"):
+                    replaced: int = _downsample_images(doc, dpi)
+                if replaced:
+                    console.print_line(f"Downsampled {replaced} images to {dpi} dpi")
+            with metrics.timed("encode"):
+                doc.save(
+                    out_file,
+                    garbage=4,
+                    clean=True,
+                    deflate=True,
+                    deflate_images=True,
+                    deflate_fonts=True,
+                    linear=LINEARIZE,
+                )
+        except Exception as e:
+            out_file.unlink(missing_ok=True)
+            raise ConvertError(f"Unable to optimize {in_file}: {e}")
+
+    # Some masters are already as small as they get
+    if out_file.stat().st_size >= in_file.stat().st_size:
+        shutil.copy2(in_file, out_file)
+        return out_file
 
-    return response
+    console.print_line(
+        f"Optimized pdf from {in_file.stat().st_size / 1000**2:.1f} MB "
+        f"to {out_file.stat().st_size / 1000**2:.1f} MB"
+    )
+    return out_file
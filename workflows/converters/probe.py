@@ -0,0 +1,144 @@
+import json
+from pathlib import Path
+from typing import Any, List, Dict, Optional
+
+from workflows.utils import metrics, sp
+from .exceptions import ConvertError
+
+
+CMD_PATH = Path.home() / ".aca" / "workflows" / "bin" / "ffprobe.exe"
+
+
+def probe(in_file: Path, timeout: int = 30) -> Dict[str, Any]:
+    """Returns the container-format and streams of a media-file, as reported
+    by ffprobe.
+
+    Parameters
+    ----------
+    in_file : Path
+        Path to the media-file
+    timeout : int
+        Number of seconds before timeout
+
+    Returns
+    -------
+    Dict with the keys "format" and "streams", as in ffprobe's json-output
+
+    Raises
+    ------
+    ConvertError
+        If ffprobe fails or cannot read the file
+    """
+
+    cmd = [
+        CMD_PATH,
+        "-v",
+        "error",
+        "-show_format",
+        "-show_streams",
+        "-of",
+        "json",
+        in_file,
+    ]
+    try:
+        info: Dict[str, Any] = json.loads(sp.run(cmd, timeout))
+    except sp.ProcessError as e:
+        raise ConvertError(f"Unable to probe {in_file}: {e}")
+    except Exception as e:
+        raise ConvertError(f"Unable to probe {in_file}: {e}")
+
+    info.setdefault("format", {})
+    info.setdefault("streams", [])
+    return info
+
+
+def keyframe_after(
+    in_file: Path, seconds: float, window: float = 30, timeout: int = 30
+) -> Optional[float]:
+    """Returns the timestamp of the first keyframe of the first video-stream at
+    or after seconds, looking no further than window seconds. Only the packets
+    around seconds are read.
+
+    Returns
+    -------
+    The timestamp in seconds, or None if there is no keyframe in the window
+    """
+
+    cmd = [
+        CMD_PATH,
+        "-v",
+        "error",
+        "-select_streams",
+        "v:0",
+        "-read_intervals",
+        f"{seconds:.3f}%+{window:.3f}",
+        "-show_entries",
+        "packet=pts_time,flags",
+        "-of",
+        "csv=p=0",
+        in_file,
+    ]
+    try:
+        lines: List[str] = sp.run(cmd, timeout).decode().splitlines()
+    except Exception as e:
+        raise ConvertError(f"Unable to probe {in_file}: {e}")
+
+    for line in lines:
+        pts_time, _, flags = line.partition(",")
+        try:
+            pts: float = float(pts_time)
+        except ValueError:
+            continue
+        if "K" in flags and pts >= seconds:
+            return pts
+    return None
+
+
+def try_probe(in_file: Path) -> Optional[Dict[str, Any]]:
+    """Returns probe(in_file), or None if in_file cannot be probed"""
+
+    try:
+        with metrics.timed("probe"):
+            return probe(in_file)
+    except ConvertError:
+        return None
+
+
+def streams(info: Dict[str, Any], codec_type: str) -> List[Dict[str, Any]]:
+    """Returns the streams of a codec_type ("video", "audio", ...) in info.
+    Cover-art and other still images are not counted as video."""
+
+    return [
+        s
+        for s in info["streams"]
+        if s.get("codec_type") == codec_type
+        and not s.get("disposition", {}).get("attached_pic")
+    ]
+
+
+def duration(info: Dict[str, Any]) -> Optional[float]:
+    """Returns the duration in seconds of the media in info, if known"""
+
+    try:
+        return float(info["format"]["duration"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def start_time(info: Dict[str, Any]) -> float:
+    """Returns the timestamp in seconds where the media in info starts"""
+
+    try:
+        return float(info["format"]["start_time"])
+    except (KeyError, TypeError, ValueError):
+        return 0.0
+
+
+def bit_rate(info: Dict[str, Any]) -> Optional[int]:
+    """Returns the overall bit rate in bits per second of the media in info,
+    if known"""
+
+    try:
+        return int(info["format"]["bit_rate"])
+    except (KeyError, TypeError, ValueError):
+        return None
@@ -0,0 +1,173 @@
+import math
+from pathlib import Path
+from typing import Any, List, Dict, Optional, Tuple
+
+from PIL import Image
+
+# Images that would take more bytes than this to decode fully are read and
+# reduced in strips instead, if their format allows it
+MEMORY_BUDGET = 1000**3
+
+# Modes that can be reduced in strips. 16-bit modes are reduced as 32-bit.
+STREAMABLE_MODES = ["L", "RGB", "RGBA", "I;16", "I;16L", "I;16B", "I;16N"]
+
+
+def fit(size: Tuple[int, int], box: int) -> Tuple[int, int]:
+    """Returns size scaled down to fit within a box x box square, keeping the
+    aspect-ratio. Like Image.thumbnail(), it never enlarges."""
+
+    width, height = size
+    if width <= box and height <= box:
+        return size
+
+    # Of the two nearest integers, pick the one giving the closest aspect-ratio,
+    # the same way as Image.thumbnail()
+    aspect: float = width / height
+    if width >= height:
+        short = min(
+            math.floor(box / aspect),
+            math.ceil(box / aspect),
+            key=lambda n: abs(aspect - box / n) if n else math.inf,
+        )
+        return box, max(short, 1)
+    short = min(
+        math.floor(box * aspect),
+        math.ceil(box * aspect),
+        key=lambda n: abs(aspect - n / box),
+    )
+    return max(short, 1), box
+
+
+def cascade(
+    img: Any, sizes: List[int], source_size: Optional[Tuple[int, int]] = None
+) -> List[Any]:
+    """Returns a thumbnail of img for each of the sizes, in the same order.
+
+    Each thumbnail fits within a size x size square, like Image.thumbnail().
+    If img has been reduced while decoding, source_size is the size of the
+    image before it was reduced, so the thumbnails get the same dimensions
+    as when made from the full image. See cascade_to().
+    """
+
+    # Compute from the original size, so rounding does not add up
+    return cascade_to(img, [fit(source_size or img.size, size) for size in sizes])
+
+
+def cascade_to(img: Any, targets: List[Tuple[int, int]]) -> List[Any]:
+    """Returns img resized to each of the target (width, height), in the same
+    order.
+
+    The targets are made largest first, each one resized from the previous,
+    so only the largest is resized from the full image, and the full image
+    is never copied. Results may be img itself, or shared between equal
+    targets, so they must not be modified in place.
+    """
+
+    resized: Dict[Tuple[int, int], Any] = {}
+    previous: Any = img
+    for target in sorted(set(targets), key=lambda t: t[0] * t[1], reverse=True):
+        if target != previous.size:
+            previous = previous.resize(
+                target, Image.Resampling.BICUBIC, reducing_gap=2.0
+            )
+        resized[target] = previous
+
+    return [resized[target] for target in targets]
+
+
+def decoded_size(img: Any) -> int:
+    """Returns the bytes needed to hold img fully decoded, as estimated from
+    the dimensions and mode in its header"""
+
+    pixels: int = img.width * img.height
+    if img.mode in ["1", "L", "P"]:
+        return pixels
+    if img.mode.startswith("I;16"):
+        return pixels * 2
+    return pixels * 4
+
+
+def _raw_tiles(img: Any) -> Optional[List[Tuple[Tuple[int, ...], int, str, int]]]:
+    """Returns the extents, file-offset, rawmode and bytes per row of each
+    tile of img, or None if the tiles are not uncompressed top-down rows that
+    can be read one by one"""
+
+    tiles: List[Tuple[Tuple[int, ...], int, str, int]] = []
+    for tile in img.tile:
+        codec, extents, offset, args = tile[0], tile[1], tile[2], tile[3]
+        if codec != "raw" or not isinstance(args, tuple) or len(args) != 3:
+            return None
+        rawmode, stride, ystep = args
+        if ystep != 1:
+            return None
+        if not stride:
+            width: int = extents[2] - extents[0]
+            try:
+                stride = len(Image.new(img.mode, (width, 1)).tobytes("raw", rawmode))
+            except Exception:
+                return None
+        tiles.append((tuple(extents), offset, rawmode, stride))
+
+    # Tiles covering the same area hold separate planes of the image
+    if len({t[0] for t in tiles}) != len(tiles):
+        return None
+    return tiles
+
+
+def reduce_streamed(
+    in_file: Path, img: Any, size: int, memory_budget: int = MEMORY_BUDGET
+) -> Optional[Any]:
+    """Returns img reduced by an integer factor, so that it is still at least
+    twice the size of the largest thumbnail, without decoding it fully.
+
+    The uncompressed pixels of img are read from in_file in strips of whole
+    rows, and each strip is reduced into the result by box-averaging. Only
+    one strip, of at most about memory_budget bytes, is held at a time.
+
+    Returns
+    -------
+    The reduced image, in the mode of img and with its exif, or None if img
+    is not large enough to be worth it or cannot be read in strips. Then it
+    must be decoded fully.
+    """
+
+    factor: int = max(img.width, img.height) // (size * 2)
+    tiles = _raw_tiles(img)
+    if factor < 2 or tiles is None or img.mode not in STREAMABLE_MODES:
+        return None
+
+    # 16-bit images are reduced as 32-bit, as Pillow can't reduce 16-bit
+    wide: bool = img.mode.startswith("I;16")
+    work_mode: str = "I" if wide else img.mode
+    reduced: Any = Image.new(
+        work_mode, (math.ceil(img.width / factor), math.ceil(img.height / factor))
+    )
+
+    # Whole rows of the source in each strip, as a multiple of factor, leaving
+    # room for the raw bytes, the decoded strip and its 32-bit version
+    rows: int = max(memory_budget // (img.width * 10) // factor, 1) * factor
+    with open(in_file, "rb") as ifile:
+        for top in range(0, img.height, rows):
+            bottom: int = min(top + rows, img.height)
+            strip: Any = Image.new(img.mode, (img.width, bottom - top))
+            for (x0, y0, x1, y1), offset, rawmode, stride in tiles:
+                first, last = max(y0, top), min(y1, bottom)
+                if first >= last:
+                    continue
+                ifile.seek(offset + (first - y0) * stride)
+                data: bytes = ifile.read((last - first) * stride)
+                part: Any = Image.frombytes(
+                    img.mode, (x1 - x0, last - first), data, "raw", rawmode, stride, 1
+                )
+                strip.paste(part, (x0, first - top))
+            if wide:
+                strip = strip.convert("I")
+            reduced.paste(strip.reduce(factor), (0, top // factor))
+
+    if wide:
+        reduced = reduced.convert(img.mode)
+    # Keep the orientation of the source
+    exif: Any = img.getexif()
+    if exif:
+        reduced.info["exif"] = exif.tobytes()
+    return reduced
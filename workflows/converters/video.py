@@ -1,13 +1,40 @@
+import io
+import math
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from os import environ as env
-from typing import List, Dict
+from typing import Any, List, Dict, Optional, Tuple
 
-from workflows.utils import sp, watermark
+from PIL import Image
+
+from workflows.utils import metrics, sp, watermark
+from . import ffmpeg, probe, resize
 from .exceptions import ConvertError
 
 
 CMD_PATH = Path.home() / ".aca" / "workflows" / "bin" / "ffmpeg.exe"
 
+# Masters with these codecs are remuxed into the access-copy without
+# re-encoding. Masters with a higher overall bit rate are transcoded anyway,
+# to keep the access-copies streamable.
+COPY_VIDEO_CODECS = ["h264"]
+COPY_PIX_FMTS = ["yuv420p", "yuvj420p"]
+COPY_AUDIO_CODECS = ["aac"]
+MAX_COPY_BIT_RATE = 10_000_000
+
+# When asked to, masters longer than this many seconds are transcoded in
+# segments of SEGMENT_SECONDS, in parallel
+SEGMENT_MIN_DURATION = 30 * 60
+SEGMENT_SECONDS = 10 * 60
+
+# Allowed difference between master and segmented access-copy, in duration
+# (as a fraction) and in the offset between audio and video (in seconds)
+DURATION_TOLERANCE = 0.005
+SYNC_TOLERANCE = 0.2
+
 
 def thumbnails(
     in_file: Path,
@@ -32,42 +59,280 @@ def thumbnails(
     if not out_dir.exists():
         out_dir.mkdir(parents=True, exist_ok=True)
 
-    response: List[Path] = []
-    for thumb in thumbnails:
-        out_file: Path = out_dir / f"{in_file.stem}{thumb['suffix']}{extension}"
-
-        if out_file.exists():
-            if not overwrite:
-                raise FileExistsError(f"File already exists: {out_file}")
-            else:
-                out_file.unlink()
-
-        size = thumb["size"]
-
-        cmd = [
-            CMD_PATH,
-            "-loglevel",
-            "error",
-            "-ss",
-            f"00:00:{offset:02}",
-            "-i",
-            in_file,
-            "-vframes",
-            "1",
-            "-filter:v",
-            f"scale={size}:-1",
-            out_file,
-        ]
+    out_files: List[Path] = [
+        out_dir / f"{in_file.stem}{thumb['suffix']}{extension}" for thumb in thumbnails
+    ]
+    for out_file in out_files:
+        if out_file.exists() and not overwrite:
+            raise FileExistsError(f"File already exists: {out_file}")
+
+    return frame_thumbnails(
+        _grab_frame(in_file, offset), out_files, thumbnails, no_watermark
+    )
+
+
+def _grab_frame(in_file: Path, seconds: float) -> Any:
+    """Returns the frame at seconds in in_file as a PIL Image. The frame is
+    decoded once, and piped as ppm (raw rgb with a header)."""
+
+    cmd = [
+        CMD_PATH,
+        "-loglevel",
+        "error",
+        "-ss",
+        f"{seconds:.3f}",
+        "-i",
+        in_file,
+        "-frames:v",
+        "1",
+        "-f",
+        "image2pipe",
+        "-c:v",
+        "ppm",
+        "-",
+    ]
+    try:
+        with metrics.timed("ffmpeg"):
+            frame: bytes = sp.run(cmd, timeout=30)
+    except sp.ProcessError as e:
+        raise ConvertError(f"ProcessError: {e}")
+    except sp.TimeoutError as e:
+        raise ConvertError(f"TimeoutError: {e}")
+    if not frame:
+        raise ConvertError(f"No frame at {seconds} seconds in {in_file}")
+
+    return Image.open(io.BytesIO(frame))
+
+
+def frame_thumbnails(
+    frame: Any,
+    out_files: List[Path],
+    thumbnails: List[Dict],
+    no_watermark: bool = False,
+) -> List[Path]:
+    """Saves a thumbnail of a decoded video-frame to each of out_files. Like
+    ffmpeg's scale-filter, each thumbnail is scaled to the width in its size,
+    keeping the aspect-ratio."""
 
-        sp.run(cmd, timeout=30)
+    targets: List[Tuple[int, int]] = [
+        (t["size"], max(round(frame.height * t["size"] / frame.width), 1))
+        for t in thumbnails
+    ]
+    with metrics.timed("resize"):
+        resized: List[Any] = resize.cascade_to(frame.convert("RGB"), targets)
+
+    # If larger than watermark-width, add watermark
+    if not no_watermark:
+        with metrics.timed("watermark"):
+            resized = watermark.add_watermark_to_images(
+                resized, min_width=int(env["SAM_WATERMARK_WIDTH"])
+            )
+
+    for out_file, img in zip(out_files, resized):
+        try:
+            with metrics.timed("encode"):
+                img.save(out_file)
+        except Exception as e:
+            raise ConvertError(f"Error saving thumbnail {out_file}: {e}")
+
+    return out_files
+
+
+def _web_compatible(info: Optional[Dict[str, Any]]) -> bool:
+    """Returns True if the first video- and audio-stream in the probed info
+    can be copied as they are into an mp4 that browsers play, so that
+    re-encoding is not needed"""
+
+    if info is None:
+        return False
+
+    videos: List[Dict[str, Any]] = probe.streams(info, "video")
+    audios: List[Dict[str, Any]] = probe.streams(info, "audio")
+    if not videos:
+        return False
+    video: Dict[str, Any] = videos[0]
+    if video.get("codec_name") not in COPY_VIDEO_CODECS:
+        return False
+    if video.get("pix_fmt") not in COPY_PIX_FMTS:
+        return False
+    # Resolution must be even, as when transcoding
+    if video.get("width", 1) % 2 or video.get("height", 1) % 2:
+        return False
+    if audios and audios[0].get("codec_name") not in COPY_AUDIO_CODECS:
+        return False
+    return (probe.bit_rate(info) or 0) <= MAX_COPY_BIT_RATE
+
+
+def _segment_count(duration: Optional[float], segments: int, cpu_budget: int) -> int:
+    """Returns the number of segments to transcode a video of duration seconds
+    in. segments > 0 is used as is, and 0 picks the number by duration."""
+
+    if segments > 0:
+        return segments
+    if not duration or duration < SEGMENT_MIN_DURATION or cpu_budget < 2:
+        return 1
+    return math.ceil(duration / SEGMENT_SECONDS)
+
+
+def _cut_points(in_file: Path, info: Dict[str, Any], count: int) -> List[float]:
+    """Returns the start of each of count segments of in_file, in seconds from
+    the start of the file. Segments start at the first keyframe after an even
+    split, so no frames are decoded only to be dropped."""
+
+    duration: float = probe.duration(info) or 0.0
+    start: float = probe.start_time(info)
+    cuts: List[float] = [0.0]
+    for i in range(1, count):
+        nominal: float = start + duration * i / count
+        keyframe: Optional[float] = probe.keyframe_after(in_file, nominal)
+        cut: float = (keyframe if keyframe is not None else nominal) - start
+        if cut > cuts[-1] and cut < duration:
+            cuts.append(cut)
+    return cuts
+
+
+def _check_segmented(in_file: Path, info: Dict[str, Any], out_file: Path) -> None:
+    """Raises ConvertError if the duration of out_file differs from that of
+    the master in info, or if its audio and video are out of sync compared
+    to the master"""
+
+    out_info: Dict[str, Any] = probe.probe(out_file)
+    expected: float = probe.duration(info) or 0.0
+    actual: float = probe.duration(out_info) or 0.0
+    if abs(actual - expected) > max(DURATION_TOLERANCE * expected, 1.0):
+        raise ConvertError(
+            f"Access-copy of {in_file} is {actual:.1f} seconds, expected {expected:.1f}"
+        )
+
+    def drift(i: Dict[str, Any]) -> Optional[float]:
+        try:
+            video = float(probe.streams(i, "video")[0]["duration"])
+            audio = float(probe.streams(i, "audio")[0]["duration"])
+        except (IndexError, KeyError, ValueError):
+            return None
+        return video - audio
+
+    in_drift, out_drift = drift(info), drift(out_info)
+    if in_drift is not None and out_drift is not None:
+        if abs(out_drift - in_drift) > SYNC_TOLERANCE:
+            raise ConvertError(
+                f"Audio and video of access-copy of {in_file} are "
+                f"{out_drift - in_drift:.2f} seconds out of sync"
+            )
+
+
+def _convert_segmented(
+    in_file: Path,
+    out_file: Path,
+    info: Dict[str, Any],
+    count: int,
+    timeout: int,
+    quality: int,
+    cpu_budget: int,
+) -> None:
+    """Transcodes in_file to out_file in count segments, split at keyframes
+    and encoded in parallel ffmpeg-processes sharing cpu_budget threads. The
+    audio is encoded whole, alongside the segments, so the segments join
+    without gaps. Video-segments and audio are then joined into the mp4
+    without re-encoding, and checked against the master."""
+
+    duration: float = probe.duration(info) or 0.0
+    cuts: List[float] = _cut_points(in_file, info, count)
+    ends: List[Optional[float]] = [*cuts[1:], None]
+    has_audio: bool = bool(probe.streams(info, "audio"))
+    parallel: int = max(min(len(cuts) + has_audio, cpu_budget), 1)
+    threads: int = max(cpu_budget // parallel, 1)
+
+    scratch: Path = Path(tempfile.mkdtemp(prefix=".segments-", dir=out_file.parent))
+    try:
+        jobs: List[Tuple[List, float, str]] = []
+        parts: List[Path] = []
+        for i, (start, end) in enumerate(zip(cuts, ends)):
+            part: Path = scratch / f"{i:04}.mp4"
+            parts.append(part)
+            cmd: List = [CMD_PATH, "-loglevel", "error", "-ss", f"{start:.6f}"]
+            if end is not None:
+                cmd += ["-t", f"{end - start:.6f}"]
+            cmd += [
+                "-i",
+                in_file,
+                "-an",
+                "-crf",
+                f"{quality}",
+                "-vf",
+                "scale=trunc(iw/2)*2:trunc(ih/2)*2",
+                "-vcodec",
+                "h264",
+                "-threads",
+                f"{threads}",
+                part,
+            ]
+            length: float = (end if end is not None else duration) - start
+            jobs.append((cmd, length, f"{in_file.name} [{i + 1}/{len(cuts)}]"))
 
-        if not no_watermark:
-            if size > int(env["SAM_WATERMARK_WIDTH"]):
-                watermark.add_watermark_to_path(out_file)
+        audio: Path = scratch / "audio.m4a"
+        if has_audio:
+            cmd = [CMD_PATH, "-loglevel", "error", "-i", in_file, "-vn"]
+            cmd += ["-map", "0:a:0", "-acodec", "aac", audio]
+            jobs.append((cmd, duration, f"{in_file.name} [audio]"))
 
-        response.append(out_file)
+        # The jobs run in threads of their own, where ffmpeg.run() records
+        # no metrics, so they are timed here
+        with metrics.timed("ffmpeg"):
+            with ThreadPoolExecutor(max_workers=parallel) as executor:
+                futures = [
+                    executor.submit(
+                        ffmpeg.run,
+                        cmd,
+                        ffmpeg.timeout_for(length, timeout),
+                        length,
+                        name,
+                    )
+                    for cmd, length, name in jobs
+                ]
+                for future in futures:
+                    future.result()
 
-    return response
+        # Join the segments and audio without re-encoding
+        playlist: Path = scratch / "segments.txt"
+        with open(playlist, "w", encoding="utf-8") as ofile:
+            for part in parts:
+                escaped: str = part.as_posix().replace("'", "'\\''")
+                ofile.write(f"file '{escaped}'\n")
+        cmd = [CMD_PATH, "-loglevel", "error", "-f", "concat", "-safe", "0"]
+        cmd += ["-i", playlist]
+        if has_audio:
+            cmd += ["-i", audio, "-map", "0:v:0", "-map", "1:a:0"]
+        cmd += ["-c", "copy", "-movflags", "+faststart", out_file]
+        ffmpeg.run(cmd, ffmpeg.timeout_for(duration, timeout), duration, in_file.name)
+
+        with metrics.timed("probe"):
+            _check_segmented(in_file, info, out_file)
+    except ConvertError:
+        out_file.unlink(missing_ok=True)
+        raise
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def _access_copy_args(quality: int, copy: bool) -> List:
+    """Returns the ffmpeg output-options for the mp4 access-copy"""
+
+    if copy:
+        # Copy the streams as they are into the mp4
+        args: List = ["-map", "0:v:0", "-map", "0:a:0?", "-c", "copy"]
+    else:
+        args = [
+            "-crf",
+            f"{quality}",
+            "-vf",
+            "scale=trunc(iw/2)*2:trunc(ih/2)*2",
+            "-vcodec",
+            "h264",
+            "-acodec",
+            "aac",
+        ]
+    return args + ["-movflags", "+faststart"]
 
 
 def convert(
@@ -76,7 +341,22 @@ def convert(
     timeout: int = 180,
     quality: int = 30,
     overwrite: bool = False,
+    remux: bool = True,
+    segments: int = 1,
+    cpu_budget: int = 0,
 ) -> None:
+    """Generates an mp4 access-copy of a video-master. Web-compatible masters
+    are remuxed, and others transcoded to h264/aac.
+
+    segments > 1 transcodes the master in that number of segments in
+    parallel, and 0 transcodes masters longer than SEGMENT_MIN_DURATION in
+    segments of SEGMENT_SECONDS. Each segment reads its part of the master,
+    and the audio is read whole besides, so segments are only worth it for
+    masters on a local disk. Defaults to 1, transcoding the master whole.
+    cpu_budget is the number of threads the segments may use together, by
+    default all cpus.
+    """
+
     if not in_file.is_file():
         raise FileNotFoundError(f"Input-path not a video file: {in_file}")
 
@@ -89,32 +369,117 @@ def convert(
         else:
             out_file.unlink()
 
-    cmd = [
-        CMD_PATH,
-        "-loglevel",
-        "error",
-        "-i",
-        in_file,
-        "-crf",
-        f"{quality}",
-        "-movflags",
-        "+faststart",
-        "-vf",
-        "scale=trunc(iw/2)*2:trunc(ih/2)*2",
-        "-vcodec",
-        "h264",
-        "-acodec",
-        "aac",
-        out_file,
+    info: Optional[Dict[str, Any]] = probe.try_probe(in_file)
+    duration: Optional[float] = probe.duration(info) if info else None
+    copy: bool = remux and _web_compatible(info)
+    cpu_budget = cpu_budget or os.cpu_count() or 1
+    count: int = _segment_count(duration, segments, cpu_budget)
+    if info is not None and not copy and count > 1:
+        _convert_segmented(in_file, out_file, info, count, timeout, quality, cpu_budget)
+        return
+
+    cmd: List = [CMD_PATH, "-loglevel", "error", "-i", in_file]
+    cmd += _access_copy_args(quality, copy) + [out_file]
+    ffmpeg.run(cmd, ffmpeg.timeout_for(duration, timeout), duration, in_file.name)
+
+
+def convert_with_thumbnails(
+    in_file: Path,
+    out_file: Path,
+    out_dir: Path,
+    thumbnails: List[Dict] = [
+        {"size": 150, "suffix": "_s"},
+        {"size": 640, "suffix": "_m"},
+    ],
+    timeout: int = 180,
+    quality: int = 30,
+    no_watermark: bool = False,
+    overwrite: bool = False,
+    remux: bool = True,
+    extension: str = ".png",
+    offset: int = 12,
+    segments: int = 1,
+    cpu_budget: int = 0,
+) -> List[Path]:
+    """Generates the mp4 access-copy like convert() and the thumbnails like
+    thumbnails(), in a single ffmpeg-run that reads the master once. The
+    thumbnail-frame is a second output of the same decode, piped as ppm.
+
+    Videos shorter than twice the offset get their thumbnails from the
+    middle of the video. Videos that are transcoded in segments, see
+    convert(), get their thumbnail-frame from a seek instead, as do remuxed
+    videos without a keyframe after the offset.
+
+    Returns
+    -------
+    List of paths to the thumbnails, in the order of thumbnails
+    """
+
+    # validate
+    if not in_file.is_file():
+        raise FileNotFoundError(f"Input-path not a video-file: {in_file}")
+
+    if in_file.suffix not in env["SAM_VIDEO_FORMATS"]:
+        raise ConvertError(f"Unsupported fileformat: {in_file}")
+
+    # setup
+    for directory in [out_file.parent, out_dir]:
+        if not directory.exists():
+            directory.mkdir(parents=True, exist_ok=True)
+
+    out_files: List[Path] = [
+        out_dir / f"{in_file.stem}{thumb['suffix']}{extension}" for thumb in thumbnails
     ]
-    try:
-        sp.run(cmd, timeout)
-    except sp.ProcessError as e:
-        raise ConvertError(f"ProcessError: {e}")
-    except sp.TimeoutError as e:
-        raise ConvertError(f"TimeoutError: {e}")
-    except Exception as e:
-        raise ConvertError(f"Unspecified error: {e}")
+    for path in [out_file] + out_files:
+        if path.exists() and not overwrite:
+            raise FileExistsError(f"File already exists: {path}")
+    if out_file.exists():
+        out_file.unlink()
+
+    info: Optional[Dict[str, Any]] = probe.try_probe(in_file)
+    duration: Optional[float] = probe.duration(info) if info else None
+    seconds: float = min(offset, duration / 2) if duration else offset
+
+    copy: bool = remux and _web_compatible(info)
+    cpu_budget = cpu_budget or os.cpu_count() or 1
+    count: int = _segment_count(duration, segments, cpu_budget)
+    if info is not None and not copy and count > 1:
+        _convert_segmented(in_file, out_file, info, count, timeout, quality, cpu_budget)
+        return frame_thumbnails(
+            _grab_frame(in_file, seconds), out_files, thumbnails, no_watermark
+        )
+
+    cmd: List = [CMD_PATH, "-loglevel", "error"]
+    if copy:
+        # Only the thumbnail-frame is decoded, so decode keyframes only and
+        # take the first one after the offset
+        cmd += ["-skip_frame", "nokey"]
+    cmd += ["-i", in_file] + _access_copy_args(quality, copy) + [out_file]
+    cmd += [
+        "-map",
+        "0:v:0",
+        "-ss",
+        f"{seconds:.3f}",
+        "-frames:v",
+        "1",
+        "-f",
+        "image2pipe",
+        "-c:v",
+        "ppm",
+        "-",
+    ]
+    frame: bytes = ffmpeg.run(
+        cmd, ffmpeg.timeout_for(duration, timeout), duration, in_file.name
+    )
+    # Short videos may have no keyframe after the offset, when copying
+    if not frame:
+        return frame_thumbnails(
+            _grab_frame(in_file, seconds), out_files, thumbnails, no_watermark
+        )
+
+    return frame_thumbnails(
+        Image.open(io.BytesIO(frame)), out_files, thumbnails, no_watermark
+    )
 
 
 # representations = [
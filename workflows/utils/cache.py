@@ -0,0 +1,217 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from typing import Any, List, Dict, Optional, OrderedDict, Tuple
+from pathlib import Path
+
+# Bump when converters change their output, so old artifacts are not reused
+CACHE_VERSION = 9
+
+
+class ConversionCache:
+    """Local cache of generated access-files, keyed on the checksum of the
+    master and the settings used to convert it. Each entry is a directory
+    with the artifacts of one conversion, named by their position.
+
+    Entries are written to a temporary directory and renamed into place, so
+    several worker-processes can use the cache at the same time. The size and
+    last use of the entries is indexed in memory when the cache is opened, and
+    entries are evicted when a new entry takes the cache beyond max_bytes.
+
+    Copies of the cache passed to worker-processes leave out the index. They
+    log the entries they use instead, which must be passed from drain() to
+    record() in the process that opened the cache. Entries used since the
+    cache was opened may be in use by the workers, so they are kept until
+    evict() is called without keep_since, and the cache may exceed max_bytes
+    by the entries of the job.
+    """
+
+    def __init__(self, root: Path, max_bytes: int) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.opened: float = time.time()
+
+        # Size and time of last use of each entry, least recently used first
+        self._index: Optional[OrderedDict[str, Tuple[int, float]]] = OrderedDict(
+            (entry.name, (size, mtime)) for mtime, size, entry in sorted(self._entries())
+        )
+        self._total: int = sum(size for size, _ in self._index.values())
+        # Set when the cache is full with entries that can't be evicted yet
+        self._full: bool = False
+        self._log: List[Tuple[str, int]] = []
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Copies for the worker-processes only log the entries they use
+        return {**self.__dict__, "_index": None, "_total": 0, "_log": []}
+
+    @staticmethod
+    def key(
+        algorithm: str, checksum: str, converter: str, params: Dict[str, Any]
+    ) -> str:
+        """Returns the cache-key for converting a master with the given
+        checksum using the given converter and parameters"""
+
+        parts = [CACHE_VERSION, algorithm.lower(), checksum.lower(), converter, params]
+        encoded: bytes = json.dumps(parts, sort_keys=True, default=str).encode()
+        return hashlib.sha256(encoded).hexdigest()
+
+    def fetch(self, key: str, out_files: List[Path], overwrite: bool = False) -> bool:
+        """Copies the artifacts of a cache-entry to out_files. Returns False if
+        there is no such entry.
+
+        Raises
+        ------
+        FileExistsError
+            If one of the out_files exists and overwrite is False
+        """
+
+        entry: Path = self.root / key
+        if not entry.is_dir():
+            return False
+
+        artifacts: List[Path] = [
+            entry / f"{i}{f.suffix}" for i, f in enumerate(out_files)
+        ]
+        if not all(a.is_file() for a in artifacts):
+            return False
+
+        for out_file in out_files:
+            if out_file.exists() and not overwrite:
+                raise FileExistsError(f"File already exists: {out_file}")
+
+        # The mtime of the entry marks when it was last used. It is set before
+        # copying, so the entry is not evicted while being copied.
+        try:
+            os.utime(entry)
+            size: int = sum(a.stat().st_size for a in artifacts)
+            for artifact, out_file in zip(artifacts, out_files):
+                out_file.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copyfile(artifact, out_file)
+        except FileNotFoundError:
+            # Evicted before it could be marked as used
+            return False
+
+        self.record([(key, size)])
+        return True
+
+    def store(self, key: str, files: List[Path]) -> None:
+        """Adds the artifacts of a conversion to the cache"""
+
+        # Stop adding entries once the cache is full with entries that can't
+        # be evicted yet
+        entry: Path = self.root / key
+        if self._full or entry.exists() or not all(f.is_file() for f in files):
+            return
+
+        # Never add entries larger than the cache
+        size: int = sum(f.stat().st_size for f in files)
+        if size > self.max_bytes:
+            return
+
+        tmp: Path = self.root / f".tmp-{uuid.uuid4().hex}"
+        tmp.mkdir()
+        try:
+            for i, f in enumerate(files):
+                shutil.copyfile(f, tmp / f"{i}{f.suffix}")
+            tmp.rename(entry)
+        except OSError:
+            # Another worker stored the same entry first
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+
+        self.record([(key, size)])
+
+    def record(self, used: List[Tuple[str, int]]) -> None:
+        """Indexes entries as used now, given by their key and size, and
+        evicts the least recently used entries if the cache has grown beyond
+        max_bytes. Copies of the cache in worker-processes log the entries
+        instead."""
+
+        if self._index is None:
+            self._log.extend(used)
+            return
+
+        now: float = time.time()
+        for key, size in used:
+            previous: Tuple[int, float] = self._index.pop(key, (0, now))
+            self._total += size - previous[0]
+            self._index[key] = (size, now)
+
+        if self._total > self.max_bytes:
+            self.evict(keep_since=self.opened)
+
+    def drain(self) -> List[Tuple[str, int]]:
+        """Returns and clears the log of entries used by a copy of the cache in
+        a worker-process, to be passed to record()"""
+
+        log: List[Tuple[str, int]] = self._log
+        self._log = []
+        return log
+
+    def _entries(self) -> List[Tuple[float, int, Path]]:
+        """Returns the mtime, size and path of each entry. Files and other
+        strays in the cache-directory are skipped."""
+
+        entries: List[Tuple[float, int, Path]] = []
+        for entry in self.root.iterdir():
+            if entry.name.startswith(".tmp-") or not entry.is_dir():
+                continue
+            try:
+                size: int = sum(f.stat().st_size for f in entry.iterdir())
+                entries.append((entry.stat().st_mtime, size, entry))
+            except OSError:
+                # Evicted meanwhile
+                continue
+        return entries
+
+    def size(self) -> int:
+        """Returns the bytes taken by the indexed entries of the cache"""
+
+        return self._total
+
+    def evict(self, keep_since: Optional[float] = None) -> int:
+        """Removes the least recently used entries until the cache fits within
+        max_bytes. Returns the number of removed entries.
+
+        Parameters
+        ----------
+        keep_since : Optional[float]
+            Keep the entries used since this time (as from time.time()). Used
+            to evict while workers use the cache, passing the time the cache
+            was opened. Defaults to None, keeping nothing and removing the
+            temporary entries left behind by interrupted workers.
+        """
+
+        if self._index is None:
+            raise RuntimeError("Evict from the process that opened the cache")
+
+        if keep_since is None:
+            for tmp in self.root.glob(".tmp-*"):
+                shutil.rmtree(tmp, ignore_errors=True)
+
+        removed: int = 0
+        for key, (size, used) in list(self._index.items()):
+            if self._total <= self.max_bytes:
+                break
+            if keep_since is not None:
+                # The rest of the index has been used since
+                if used >= keep_since:
+                    break
+                # Workers mark the entries they fetch, before it is recorded
+                try:
+                    if (self.root / key).stat().st_mtime >= keep_since:
+                        continue
+                except FileNotFoundError:
+                    # Removed by another job
+                    pass
+            shutil.rmtree(self.root / key, ignore_errors=True)
+            del self._index[key]
+            self._total -= size
+            removed += 1
+
+        self._full = self._total > self.max_bytes
+        return removed
@@ -0,0 +1,17 @@
+import sys
+from threading import Lock
+
+_lock = Lock()
+
+
+def print_line(message: str = "") -> None:
+    """Prints message as a line, written and flushed in a single call.
+
+    The worker-processes, the upload-thread and the conversion-loop of a job
+    print to the same log. Lines printed with print() may run into each other,
+    as print() writes the message and its newline separately.
+    """
+
+    with _lock:
+        sys.stdout.write(f"{message}\n")
+        sys.stdout.flush()
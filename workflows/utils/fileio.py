@@ -1,9 +1,21 @@
 import csv
 import json
+import os
 from functools import lru_cache
-from typing import List, Dict
+from threading import Lock
+from typing import IO, List, Dict
 from pathlib import Path
 
+SAM_OUTPUT_HEADERS = [
+    "oasid",
+    "thumbnail",
+    "record_image",
+    "record_type",
+    "large_image",
+    "web_document_url",
+    "record_file",
+]
+
 
 class WrongFileExtensionError(Exception):
     """Raised when Path is not pointing to a csv-file"""
@@ -56,17 +68,80 @@ def load_csv_from_sam(input: Path) -> List[Dict]:
 
 
 def save_csv_to_sam(files: List[Dict], path: Path) -> None:
-    sam_output_headers = [
-        "oasid",
-        "thumbnail",
-        "record_image",
-        "record_type",
-        "large_image",
-        "web_document_url",
-        "record_file",
-    ]
-
     with open(path, "w", newline="") as ofile:
-        writer = csv.DictWriter(ofile, fieldnames=sam_output_headers)
+        writer = csv.DictWriter(ofile, fieldnames=SAM_OUTPUT_HEADERS)
         writer.writeheader()
         writer.writerows(files)
+
+
+class SamCsvWriter:
+    """Writes the csv-file to re-import into SAM one row at a time.
+
+    Rows are given with their idx in the input csv-file, and may come in any
+    order. They are appended to a partial csv-file next to path as they come,
+    which is flushed to disk for every batch_size rows, so it can be imported
+    into SAM if the job dies. close() writes the rows in input order to path
+    in one atomic step, and removes the partial file. Safe to use from
+    several threads.
+    """
+
+    def __init__(self, path: Path, batch_size: int = 50) -> None:
+        self.path = path
+        self.partial = path.with_name(f"{path.stem}.partial{path.suffix}")
+        self.batch_size = batch_size
+        self.count: int = 0
+        self._rows: Dict[int, Dict] = {}
+        self._lock = Lock()
+        self._file = open(self.partial, "w", newline="")
+        self._writer = csv.DictWriter(self._file, fieldnames=SAM_OUTPUT_HEADERS)
+        self._writer.writeheader()
+
+    def write(self, idx: int, filedata: Dict) -> None:
+        """Writes the row with the given idx
+
+        Raises
+        ------
+        ValueError
+            If a row with the same idx has already been written
+        """
+
+        with self._lock:
+            if idx in self._rows:
+                raise ValueError(f"Row {idx} has already been written")
+            self._rows[idx] = filedata
+            self.count += 1
+            self._writer.writerow(filedata)
+            if self.count % self.batch_size == 0:
+                _sync(self._file)
+
+    def close(self) -> None:
+        """Writes the rows to path in input order, and removes the partial
+        file"""
+
+        with self._lock:
+            _sync(self._file)
+            self._file.close()
+
+            ordered: Path = self.path.with_name(
+                f"{self.path.stem}.ordered{self.path.suffix}"
+            )
+            with open(ordered, "w", newline="") as ofile:
+                writer = csv.DictWriter(ofile, fieldnames=SAM_OUTPUT_HEADERS)
+                writer.writeheader()
+                for idx in sorted(self._rows):
+                    writer.writerow(self._rows[idx])
+                _sync(ofile)
+            os.replace(ordered, self.path)
+            self.partial.unlink()
+
+    def discard(self) -> None:
+        """Closes and removes the partial file"""
+
+        with self._lock:
+            self._file.close()
+            self.partial.unlink(missing_ok=True)
+
+
+def _sync(file: IO) -> None:
+    file.flush()
+    os.fsync(file.fileno())
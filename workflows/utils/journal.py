@@ -0,0 +1,137 @@
+import hashlib
+import json
+import sqlite3
+from threading import Lock
+from typing import Iterator, List, Dict, Tuple
+from pathlib import Path
+
+
+class JournalError(Exception):
+    """Raised when a journal cannot be used for the current job"""
+
+
+# States of a row in the journal. Rows that were skipped or failed conversion
+# are not journaled, so they are retried when a job is resumed.
+CONVERTED = "converted"
+FINISHED = "finished"
+
+
+class Journal:
+    """Persistent record of the rows in an accessfiles-job, kept in a
+    SQLite-database next to the output csv-file. Every change is committed
+    immediately, so a job that dies halfway can be resumed without
+    converting or uploading the finished rows again.
+
+    The journal is shared by the conversion- and the upload-stage, so all
+    access is serialized by a lock.
+    """
+
+    def __init__(self, path: Path, resume: bool = False) -> None:
+        if not resume:
+            # Also remove the WAL-files left behind by a crashed job
+            for suffix in ["", "-wal", "-shm"]:
+                Path(f"{path}{suffix}").unlink(missing_ok=True)
+
+        self.path = path
+        self._lock = Lock()
+        self._con = sqlite3.connect(path, check_same_thread=False)
+        self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.execute("PRAGMA synchronous=NORMAL")
+        with self._con:
+            self._con.execute(
+                "CREATE TABLE IF NOT EXISTS job (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            self._con.execute(
+                "CREATE TABLE IF NOT EXISTS rows ("
+                "file_id TEXT PRIMARY KEY, idx INTEGER, filename TEXT, "
+                "state TEXT, filedata TEXT)"
+            )
+
+    @staticmethod
+    def path_for(csv_out: Path) -> Path:
+        """Returns the path of the journal belonging to the output csv-file"""
+        return csv_out.with_name(f"{csv_out.stem}_journal.db")
+
+    def check_source(self, csv_in: Path, file_ids: List[str]) -> None:
+        """Binds the journal to the input csv-file and its rows. Raises
+        JournalError if the journal belongs to another input csv-file, or to
+        another export at the same path.
+
+        The rows are identified by their file_ids in input order, as the idx
+        of a journaled row must point at the same row when resuming.
+        """
+
+        source: str = str(csv_in.resolve())
+        digest: str = hashlib.sha256("\n".join(file_ids).encode()).hexdigest()
+        with self._lock, self._con:
+            found: Dict[str, str] = dict(
+                self._con.execute(
+                    "SELECT key, value FROM job WHERE key IN ('csv_in', 'rows')"
+                ).fetchall()
+            )
+            if found.get("csv_in", source) != source:
+                raise JournalError(
+                    f"The journal {self.path} belongs to another csv-file: "
+                    f"{found['csv_in']}"
+                )
+            if found.get("rows", digest) != digest:
+                raise JournalError(
+                    f"The journal {self.path} belongs to another export of "
+                    f"{source}. Run the job without resuming."
+                )
+            self._con.executemany(
+                "INSERT OR REPLACE INTO job VALUES (?, ?)",
+                [("csv_in", source), ("rows", digest)],
+            )
+
+    def states(self) -> Dict[str, str]:
+        """Returns the state of all journaled rows by their file_id"""
+
+        with self._lock:
+            rows = self._con.execute("SELECT file_id, state FROM rows").fetchall()
+        return {file_id: state for file_id, state in rows}
+
+    def converted(self, idx: int, filename: str, filedata: Dict) -> None:
+        """Records that the access-files of a row have been generated"""
+        self._save(idx, filename, CONVERTED, filedata)
+
+    def finished(self, idx: int, filename: str, filedata: Dict) -> None:
+        """Records that a row is done, i.e. uploaded or not to be uploaded"""
+        self._save(idx, filename, FINISHED, filedata)
+
+    def unfinished(self) -> List[Tuple[int, str, Dict]]:
+        """Returns idx, filename and filedata of the converted rows, which
+        still need to be uploaded, in input order"""
+
+        with self._lock:
+            rows = self._con.execute(
+                "SELECT idx, filename, filedata FROM rows WHERE state = ? "
+                "ORDER BY idx",
+                (CONVERTED,),
+            ).fetchall()
+        return [(idx, filename, json.loads(data)) for idx, filename, data in rows]
+
+    def output(self) -> Iterator[Tuple[int, Dict]]:
+        """Yields the idx and filedata of the finished rows in input order. The
+        journal is locked until the iteration is done."""
+
+        with self._lock:
+            cursor = self._con.execute(
+                "SELECT idx, filedata FROM rows WHERE state = ? ORDER BY idx",
+                (FINISHED,),
+            )
+            for idx, data in cursor:
+                yield idx, json.loads(data)
+
+    def close(self) -> None:
+        with self._lock:
+            self._con.close()
+
+    def _save(self, idx: int, filename: str, state: str, filedata: Dict) -> None:
+        # Paths are stored as strings, which is also what ends up in the csv
+        data: str = json.dumps({k: str(v) for k, v in filedata.items()})
+        with self._lock, self._con:
+            self._con.execute(
+                "INSERT OR REPLACE INTO rows VALUES (?, ?, ?, ?, ?)",
+                (filedata["oasid"], idx, filename, state, data),
+            )
@@ -0,0 +1,135 @@
+import json
+import math
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Any, List, Dict, Iterator, Optional
+from pathlib import Path
+
+# Per-thread recorder of the row being converted. Converters record into it
+# with timed() and count(), which are no-ops when no row has begun.
+_local = threading.local()
+
+
+def begin() -> None:
+    """Starts recording the metrics of a row in the current thread"""
+    _local.row = {}
+
+
+def end() -> Dict[str, float]:
+    """Stops recording and returns the metrics of the row"""
+
+    row: Optional[Dict[str, float]] = getattr(_local, "row", None)
+    _local.row = None
+    return row or {}
+
+
+def count(key: str, value: float) -> None:
+    """Adds value to the metric key of the current row"""
+
+    row: Optional[Dict[str, float]] = getattr(_local, "row", None)
+    if row is not None:
+        row[key] = row.get(key, 0) + value
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """Adds the seconds spent in the with-block to the stage of the current
+    row"""
+
+    start: float = perf_counter()
+    try:
+        yield
+    finally:
+        count(stage, perf_counter() - start)
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Returns the nearest-rank percentile of values"""
+
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank: int = max(math.ceil(pct / 100 * len(ordered)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+class Report:
+    """Collects the metrics of all rows in an accessfiles-job and summarizes
+    them per kind of master. Safe to use from several threads."""
+
+    def __init__(self) -> None:
+        self._rows: Dict[int, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, idx: int, values: Dict[str, Any]) -> None:
+        """Merges values into the metrics of the row. Numbers are summed."""
+
+        with self._lock:
+            row: Dict[str, Any] = self._rows.setdefault(idx, {"idx": idx})
+            for k, v in values.items():
+                if isinstance(v, (int, float)) and isinstance(row.get(k), (int, float)):
+                    row[k] += v
+                else:
+                    row[k] = v
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """Returns totals, throughput and percentiles per kind of master.
+
+        Only the rows that were converted are summarized. Rows marked as not
+        converted (with "converted": False), like missing masters and failed
+        conversions, are only counted. Rows without a kind, like the rows only
+        uploaded when resuming a job, are left out.
+        """
+
+        with self._lock:
+            rows: List[Dict[str, Any]] = list(self._rows.values())
+
+        summary: Dict[str, Dict[str, Any]] = {}
+        for kind in sorted({r["kind"] for r in rows if r.get("kind")}):
+            of_kind = [
+                r for r in rows if r.get("kind") == kind and r.get("converted", True)
+            ]
+            not_converted: int = sum(
+                1 for r in rows if r.get("kind") == kind and not r.get("converted", True)
+            )
+            stages: Dict[str, float] = {}
+            for r in of_kind:
+                for k, v in r.items():
+                    if k not in [
+                        "idx",
+                        "kind",
+                        "converted",
+                        "bytes_in",
+                        "bytes_out",
+                    ] and isinstance(v, (int, float)):
+                        stages[k] = stages.get(k, 0) + v
+
+            bytes_in: int = sum(r.get("bytes_in", 0) for r in of_kind)
+            convert: List[float] = [r.get("convert", 0) for r in of_kind]
+            upload: List[float] = [r["upload"] for r in of_kind if "upload" in r]
+            summary[kind] = {
+                "rows": len(of_kind),
+                "not_converted": not_converted,
+                "bytes_in": bytes_in,
+                "bytes_out": sum(r.get("bytes_out", 0) for r in of_kind),
+                "seconds": stages,
+                "convert_mb_per_second": (
+                    bytes_in / 1e6 / sum(convert) if sum(convert) else 0.0
+                ),
+                "convert_percentiles": {
+                    f"p{p}": percentile(convert, p) for p in [50, 90, 99]
+                },
+                "upload_percentiles": {
+                    f"p{p}": percentile(upload, p) for p in [50, 90, 99]
+                },
+            }
+        return summary
+
+    def save(self, path: Path) -> None:
+        """Saves the summary and the metrics of each row as json"""
+
+        with self._lock:
+            rows = sorted(self._rows.values(), key=lambda r: r["idx"])
+        with open(path, "w", encoding="utf-8") as ofile:
+            json.dump({"summary": self.summary(), "rows": rows}, ofile, indent=2)
@@ -0,0 +1,135 @@
+import shutil
+from threading import Condition, Thread
+from typing import List, Dict, Optional, Tuple
+from pathlib import Path
+
+# States of a master in the prefetcher
+PENDING = "pending"
+COPYING = "copying"
+STAGED = "staged"
+SKIPPED = "skipped"
+
+
+class Prefetcher:
+    """Copies masters from slow storage (the M-drive) to local scratch in a
+    background thread, ahead of the conversions that read them.
+
+    The masters are staged in the order given, while at most max_files
+    staged masters and max_bytes of staged data are held at a time. Masters
+    larger than max_bytes, and masters that are asked for before their copy
+    has started, are not staged, so the conversion reads them from the
+    original location instead.
+
+    Call get() and release() from a single consumer-thread, in the order the
+    masters were given.
+    """
+
+    def __init__(
+        self,
+        masters: List[Tuple[int, Path]],
+        scratch: Path,
+        max_files: int,
+        max_bytes: int,
+    ) -> None:
+        self.scratch = scratch
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self._masters = masters
+        self._state: Dict[int, str] = {key: PENDING for key, _ in masters}
+        self._staged: Dict[int, Tuple[Path, int]] = {}
+        self._held_bytes: int = 0
+        self._stopped: bool = False
+        self._cond = Condition()
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def start(self) -> None:
+        self.scratch.mkdir(parents=True, exist_ok=True)
+        self._thread.start()
+
+    def get(self, key: int) -> Optional[Path]:
+        """Returns the path of the staged copy of the master, waiting for the
+        copy to finish if it is in progress. Returns None, if the master is
+        not staged."""
+
+        with self._cond:
+            if self._state.get(key) == PENDING:
+                # Don't wait for a copy that has not started yet
+                self._state[key] = SKIPPED
+            while self._state.get(key) == COPYING:
+                self._cond.wait()
+            if key in self._staged:
+                return self._staged[key][0]
+        return None
+
+    def release(self, key: int) -> None:
+        """Removes the staged copy of the master, if any, to make room for
+        the next ones"""
+
+        with self._cond:
+            staged: Optional[Tuple[Path, int]] = self._staged.pop(key, None)
+            if staged is None:
+                return
+            path, size = staged
+            self._held_bytes -= size
+            self._cond.notify_all()
+        shutil.rmtree(path.parent, ignore_errors=True)
+
+    def close(self) -> None:
+        """Stops staging and removes all staged copies"""
+
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread.is_alive():
+            self._thread.join()
+        for key in list(self._staged):
+            self.release(key)
+
+    def _run(self) -> None:
+        for key, source in self._masters:
+            try:
+                size: int = source.stat().st_size
+            except OSError:
+                # Let the conversion report the missing master
+                size = -1
+
+            with self._cond:
+                if size < 0 or size > self.max_bytes:
+                    self._state[key] = SKIPPED
+                    continue
+
+                while (
+                    not self._stopped
+                    and self._state[key] == PENDING
+                    and (
+                        len(self._staged) >= self.max_files
+                        or self._held_bytes + size > self.max_bytes
+                    )
+                ):
+                    self._cond.wait()
+
+                if self._stopped:
+                    return
+                if self._state[key] != PENDING:
+                    continue
+                self._state[key] = COPYING
+                self._held_bytes += size
+
+            # Keep the name of the master, as the converters name the
+            # access-files after it
+            dest: Path = self.scratch / str(key) / source.name
+            try:
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copyfile(source, dest)
+            except OSError:
+                shutil.rmtree(dest.parent, ignore_errors=True)
+                with self._cond:
+                    self._held_bytes -= size
+                    self._state[key] = SKIPPED
+                    self._cond.notify_all()
+                continue
+
+            with self._cond:
+                self._staged[key] = (dest, size)
+                self._state[key] = STAGED
+                self._cond.notify_all()
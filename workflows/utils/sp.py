@@ -1,5 +1,7 @@
 import subprocess
-from typing import List
+from threading import Thread
+from time import monotonic
+from typing import Any, Callable, List, Dict, Optional
 
 
 class ProcessError(Exception):
@@ -10,11 +12,113 @@ class TimeoutError(Exception):
     """Implements error to raise when a process call times out."""
 
 
-def run(cmd: List, timeout: int = 10) -> None:
+def run(cmd: List, timeout: int = 10) -> bytes:
+    """Runs cmd and returns its stdout. Raises ProcessError if it fails, and
+    TimeoutError if it does not finish within timeout seconds."""
     try:
-        subprocess.run(cmd, check=True, capture_output=True, timeout=timeout)
+        proc = subprocess.run(cmd, check=True, capture_output=True, timeout=timeout)
+        return proc.stdout
     except subprocess.CalledProcessError as error:
         raise ProcessError(f"Process failed with error: {error.stderr.strip().decode()}")
+    except subprocess.TimeoutExpired as error:
+        raise TimeoutError(f"Command timed out after {error.timeout} seconds.")
+
+
+def run_progress(
+    cmd: List,
+    timeout: float,
+    stall_timeout: float,
+    on_progress: Callable[[Dict[str, str]], Optional[bool]],
+) -> bytes:
+    """Runs a process that reports its progress on stderr as blocks of
+    key=value lines, each ending with a "progress"-key, like ffmpeg with
+    "-progress pipe:2". Returns its stdout.
+
+    Parameters
+    ----------
+    cmd : List
+        The cmd to execute.
+    timeout : float
+        Number of seconds the process may run in total.
+    stall_timeout : float
+        Number of seconds the process may run without advancing.
+    on_progress : Callable
+        Called with each block of progress. Returns True if the process has
+        advanced since the previous block, or None once all of the output
+        has been produced. The process is then only stopped by the timeout,
+        as it may finish without reporting progress (like ffmpeg writing
+        the trailer of an mp4).
+
+    Raises
+    ------
+    TimeoutError
+        If the process runs longer than timeout, or does not advance for
+        stall_timeout seconds. The process is killed.
+    ProcessError
+        If the process exits with exit code != 0. Lines in stderr that are not
+        progress make up the message.
+    """
+
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    start: float = monotonic()
+    state: Dict[str, Any] = {
+        "advanced": start,
+        "finishing": False,
+        "stdout": b"",
+        "errors": [],
+    }
+
+    def read_stdout() -> None:
+        state["stdout"] = proc.stdout.read() if proc.stdout else b""
+
+    def read_stderr() -> None:
+        block: Dict[str, str] = {}
+        for raw in proc.stderr or []:
+            line: str = raw.decode(errors="replace").strip()
+            key, sep, value = line.partition("=")
+            if not sep or " " in key:
+                if line:
+                    state["errors"].append(line)
+                continue
+            block[key] = value
+            if key == "progress":
+                advanced: Optional[bool] = on_progress(block)
+                if advanced is None:
+                    state["finishing"] = True
+                elif advanced:
+                    state["advanced"] = monotonic()
+                block = {}
+
+    readers: List[Thread] = [Thread(target=read_stdout), Thread(target=read_stderr)]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+
+    while True:
+        try:
+            proc.wait(timeout=1)
+            break
+        except subprocess.TimeoutExpired:
+            now: float = monotonic()
+            if now - start > timeout:
+                message = f"Command timed out after {timeout:.0f} seconds."
+            elif not state["finishing"] and now - state["advanced"] > stall_timeout:
+                message = f"Command stalled for {stall_timeout:.0f} seconds."
+            else:
+                continue
+            proc.kill()
+            proc.wait()
+            raise TimeoutError(message)
+
+    for reader in readers:
+        reader.join()
+
+    if proc.returncode != 0:
+        err_msg: str = "\n".join(state["errors"])
+        if not err_msg:
+            err_msg = f"Exited with code {proc.returncode} and empty stderr"
+        raise ProcessError(f"Process failed with error: {err_msg}")
+    return bytes(state["stdout"])
 
 
 def run_command(cmd: List, timeout: int = 10) -> None:
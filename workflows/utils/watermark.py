@@ -1,7 +1,8 @@
 from os import environ as env
 from pathlib import Path
-from typing import Any
-from PIL import Image
+from functools import lru_cache
+from typing import Any, List, Dict
+from PIL import Image, ImageStat
 
 
 class ImageError(Exception):
@@ -37,6 +38,26 @@ def add_watermark_to_path(path: Path) -> None:
         raise ImageError(f"Unable to save watermarked image to {path}: {e}")
 
 
+@lru_cache(maxsize=None)
+def _logo(path: Path) -> Any:
+    """Returns the decoded logo in path. Cached for the lifetime of the
+    process, as every watermarked thumbnail uses one of the two logos."""
+
+    logo: Any = Image.open(path)
+    logo.load()
+    return logo
+
+
+def corner_luminance(img: Image, width: int, height: int) -> float:
+    """Returns the mean luminance (0-255) of the width x height bottom-right
+    corner of img"""
+
+    corner: Any = img.crop(
+        (img.width - width, img.height - height, img.width, img.height)
+    )
+    return float(ImageStat.Stat(corner.convert("L")).mean[0])
+
+
 def add_watermark_to_image(img: Image) -> Image:
     """Adds a ACA-watermark in the bottom-right corner of the supplied PIL
     Image object.
@@ -51,28 +72,47 @@ def add_watermark_to_image(img: Image) -> Image:
     PIL Image with watermark
     """
 
-    WATERMARK_WIDTH = int(env["SAM_WATERMARK_WIDTH"])
-    WATERMARK_HEIGHT = int(env["SAM_WATERMARK_HEIGHT"])
-    WATERMARK_WHITE = Path.home() / env["APP_DIR"] / env["SAM_WATERMARK_WHITE"]
-    WATERMARK_BLACK = Path.home() / env["APP_DIR"] / env["SAM_WATERMARK_BLACK"]
+    return add_watermark_to_images([img])[0]
 
-    copy = img.copy()
-    grayscale = copy.convert("L")
 
-    anchor_x = copy.width - WATERMARK_WIDTH
-    anchor_y = copy.height - WATERMARK_HEIGHT
-    pixel_count = WATERMARK_WIDTH * WATERMARK_HEIGHT
-    pixel_values = 0
+def add_watermark_to_images(images: List[Image], min_width: int = 0) -> List[Image]:
+    """Adds a ACA-watermark in the bottom-right corner of each of the supplied
+    PIL Image objects, eg. the thumbnails of the same source. A white logo is
+    used on dark corners, and a black one on light corners.
 
-    for x in range(anchor_x, anchor_x + WATERMARK_WIDTH):
-        for y in range(anchor_y, anchor_y + WATERMARK_HEIGHT):
-            pixel_values = pixel_values + grayscale.getpixel((x, y))
+    Parameters
+    ----------
+    images : List[Image]
+        PIL Image-objects
+    min_width : int
+        Images that are not wider than this are returned without watermark
 
-    if pixel_values / pixel_count < 128:
-        logo = Image.open(WATERMARK_WHITE)
-    else:
-        logo = Image.open(WATERMARK_BLACK)
+    Returns
+    ------
+    List of PIL Images with watermark, in the order of images
+    """
 
-    copy.paste(logo, (anchor_x, anchor_y), logo)
+    WATERMARK_WIDTH = int(env["SAM_WATERMARK_WIDTH"])
+    WATERMARK_HEIGHT = int(env["SAM_WATERMARK_HEIGHT"])
+    WATERMARK_WHITE = Path.home() / env["APP_DIR"] / env["SAM_WATERMARK_WHITE"]
+    WATERMARK_BLACK = Path.home() / env["APP_DIR"] / env["SAM_WATERMARK_BLACK"]
 
-    return copy
+    # The same image may be given more than once, eg. when a source is
+    # smaller than several of its thumbnail-sizes
+    marked: Dict[int, Image] = {}
+    for img in images:
+        if img.width <= min_width or id(img) in marked:
+            continue
+
+        if corner_luminance(img, WATERMARK_WIDTH, WATERMARK_HEIGHT) < 128:
+            logo = _logo(WATERMARK_WHITE)
+        else:
+            logo = _logo(WATERMARK_BLACK)
+
+        copy = img.copy()
+        anchor_x = copy.width - WATERMARK_WIDTH
+        anchor_y = copy.height - WATERMARK_HEIGHT
+        copy.paste(logo, (anchor_x, anchor_y), logo)
+        marked[id(img)] = copy
+
+    return [marked.get(id(img), img) for img in images]